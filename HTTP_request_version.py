@@ -5,10 +5,25 @@ Created on Fri Mar 29 18:26:47 2024
 @author: yarno
 """
 
-import requests
+import math
+import threading
 import time
+import config_alpaca
 from config_alpaca import API_KEY, SECRET_KEY
-from datetime import datetime, timedelta
+from accounts import AccountRegistry
+from rate_limit import RateLimiter
+from market_clock import MarketClock, session_rejection
+from conversion_graph import ConversionGraph
+from event_log import log, correlated
+from profiling import profiled
+from order_core import check_order, build_order, time_in_force
+from transports import RequestsTransport, RequestRejected
+from backfill import backfill_orders, OrderStore
+try:
+    from market_impact import OrderBookCache
+except ImportError: #numpy is not installed, pre-trade market impact estimates are unavailable
+    OrderBookCache = None
+from datetime import datetime, timedelta, timezone
 
 trading_url = "https://api.alpaca.markets"
 market_url = "https://data.alpaca.markets"
@@ -24,52 +39,73 @@ headers_post_request = {
     "APCA-API-SECRET-KEY": f"{SECRET_KEY}"
 }
 
+#every account has its own session and rate limit for the trading endpoints, account=None is the default account
+accounts = AccountRegistry.from_config(config_alpaca, trading_url)
+default_account = accounts.get()
+rate_limiter = default_account.rate_limiter
+transport = default_account.transport
+#market data (quotes, order books) and the market clock are shared by every account, they have their own session and
+#rate limit so order validation never spends, or waits on, the trading budget of an account
+market_data_rate_limiter = RateLimiter()
+market_data_transport = RequestsTransport(market_url, API_KEY, SECRET_KEY, market_data_rate_limiter)
+#orders are submitted through their account's transport, set order_transport to override it for every account (MockTransport for dry runs)
+order_transport = None
+
 def safe_get_request(url, headers, params=None):
-    max_retries = 5
-    time_delay = 5
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to get data: {e}, retrying {attempt + 1}/{max_retries}")
-            time.sleep(time_delay)
-    raise Exception("Failed to return results")
+    if url.startswith(market_url):
+        return market_data_transport.request("GET", url, headers=headers, params=params)
+    return transport.request("GET", url, headers=headers, params=params)
 
 def safe_post_request(url, headers, json=None):
-    max_retries = 5
-    time_delay = 5
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=json, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to get data: {e}, retrying {attempt + 1}/{max_retries}")
-            time.sleep(time_delay)
-    raise Exception("Failed to return results")
-
-account = safe_get_request(f"{trading_url}/v2/account", headers=headers_get_request)
-buying_power = account.get('buying_power')
-print(f"${buying_power} is available as buying power")
+    return transport.request("POST", url, headers=headers, json=json)
+
+buying_power = default_account.info().get('buying_power')
+log.info("buying_power", buying_power=buying_power)
 
 def list_of_us_equities():
     response = safe_get_request(f"{trading_url}/v2/assets", headers=headers_get_request, params={"status": "active", "asset_class": "us_equity"})
     return[asset['symbol'] for asset in response if asset['tradable'] == True]
 
+crypto_price_increments = {}
+
 def list_of_crypto_pairs():
     response = safe_get_request(f"{trading_url}/v2/assets", headers=headers_get_request, params={"status": "active", "asset_class": "crypto"})
+    for asset in response:
+        if asset.get('price_increment'):
+            crypto_price_increments[asset['symbol']] = float(asset['price_increment'])
     return[asset['symbol'] for asset in response if asset['tradable'] == True]
 
 list_of_us_equities = list_of_us_equities()
 list_of_crypto_pairs = list_of_crypto_pairs()
+us_equities = set(list_of_us_equities)
+crypto_pairs = set(list_of_crypto_pairs)
+
+def asset_class_of(ticker):
+    if ticker in us_equities:
+        return 'us_equity'
+    if ticker in crypto_pairs:
+        return 'crypto'
+
+market_clock = MarketClock(lambda path, params: market_data_transport.request("GET", f"{trading_url}/v2{path}", params=params))
+
+def fetch_crypto_orderbooks(symbols):
+    response = safe_get_request(f"{market_url}/v1beta3/crypto/us/latest/orderbooks", headers=headers_get_request, params={"symbols": ",".join(symbols)})
+    return response['orderbooks']
+
+order_books = OrderBookCache(fetch_crypto_orderbooks) if OrderBookCache is not None else None
+
+def fetch_crypto_quotes(symbols):
+    response = safe_get_request(f"{market_url}/v1beta3/crypto/us/latest/quotes", headers=headers_get_request, params={"symbols": ",".join(symbols)})
+    return response['quotes']
+
+#usd valuations of crypto currencies all come from one batched quote snapshot
+conversion_graph = ConversionGraph(fetch_crypto_quotes, list_of_crypto_pairs)
 
 def return_latest_price(ticker:str, orderside:str):
-    if ticker in list_of_us_equities:
+    if ticker in us_equities:
         response = safe_get_request(f"{market_url}/v2/stocks/{ticker}/quotes/latest", headers=headers_get_request)
         latest_quotes = response['quote']
-    if ticker in list_of_crypto_pairs:
+    if ticker in crypto_pairs:
         response = safe_get_request(f"{market_url}/v1beta3/crypto/us/latest/quotes", headers=headers_get_request, params={"symbols": ticker})
         latest_quotes = response['quotes'][ticker]
     if orderside == 'buy':
@@ -80,318 +116,310 @@ def return_latest_price(ticker:str, orderside:str):
 orders = {}
 prices = {}
 
-def open_new_trade(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None):
+def validate_order(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, extended_hours=False, account=None):
     """
-    Function for opening new trades, supported markets: US equities and crytpocurrencies
-    Ticker for equities should be all caps (AAPL), for cryptos should represent the pair in all caps (BTC/USDT)
-    Ordertype should denote market or limit, for market and limit orders respectively
-    Orderside should denote buy or sell, for buying and selling (if open position) /shorting (if no open position), respectively
-    Shorting is only possible for US equities with non-fractionable qty
-    Notional should denote the usd value of the trade
-    Qty should denote the amount of shares or tokens to trade
-    Takeprofit and stoploss denote market prices, are only supported for US Equities
-    For stock limit orders, fractional orders will default to 'day' orders, and non-fractional orders will default to 'good until close' orders
+    Checks an order before submission, returns the reason it cannot be submitted or None if it can
     """
-    #Logic for all exception handling prior to submitting order
-    if notional is None and qty is None:
-        print("Either notional or quantity must be passed")
-        return
-    
-    if ticker not in list_of_us_equities and ticker not in list_of_crypto_pairs:
-        print(f"Asset {ticker} is not supported for trading")
-        return
-    
-    if orderside not in ['buy', 'sell']:
-        print(f"Invalid input {orderside}")
-        return
+    asset_class = asset_class_of(ticker)
+    if asset_class is None:
+        return f"Asset {ticker} is not supported for trading"
     
-    if ordertype not in ['market', 'limit']:
-        print(f"Invalid input {ordertype}")
-        return
+    if account not in accounts:
+        return f"Unknown account {account}"
     
-    if notional and qty:
-        print("Both notional and qty cannot be passed")
-        return
+    reason = check_order(asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours)
+    if reason:
+        return reason
     
+    buying_power = accounts.get(account).buying_power()
     if notional:
         if notional > float(buying_power):
-            print(f"Notional {notional}, exceeds available funds {buying_power}")
-            return
+            return f"Notional {notional}, exceeds available funds {buying_power}"
     
     if qty:
-        if ticker in list_of_crypto_pairs:
+        if asset_class == 'crypto':
             traded_token = ticker.split('/')[0]
-            usd_pair = f"{traded_token}/USD"
-            dollar_amount = qty * float(return_latest_price(usd_pair, orderside))
-            if dollar_amount > float(buying_power):
-                print(f"Amount converted to dollars {dollar_amount}, exceeds available funds {buying_power}")
-                return
+            dollar_amount = qty * conversion_graph.usd_rate(traded_token, orderside)
         else:
             dollar_amount = qty * float(return_latest_price(ticker, orderside))
-            if dollar_amount > float(buying_power):
-                print(f"Amount converted to dollars {dollar_amount}, exceeds available funds {buying_power}")
-                return
+        if dollar_amount > float(buying_power):
+            return f"Amount converted to dollars {dollar_amount}, exceeds available funds {buying_power}"
     
-    if ordertype == 'limit' and limitprice is None:
-        print("Limit price must be included with limit order type")
+    if asset_class == 'us_equity':
+        return session_rejection(market_clock, ordertype, extended_hours, tif=time_in_force(asset_class, notional, qty, extended_hours))
+
+def post_order(order_data, account=None):
+    account = accounts.get(account)
+    response = (order_transport or account).submit_order(order_data)
+    log.info("order_submitted", order_id=response['id'], account=account.key, symbol=order_data['symbol'], side=order_data['side'], type=order_data['type'], status=response.get('status'))
+    return response
+
+@correlated
+@profiled
+def open_new_trade(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, client_order_id=None, extended_hours=False, max_impact=None, impact_action='warn', route='direct', account=None):
+    """
+    Function for opening new trades, supported markets: US equities and crytpocurrencies
+    Ticker for equities should be all caps (AAPL), for cryptos should represent the pair in all caps (BTC/USDT)
+    Ordertype should denote market or limit, for market and limit orders respectively
+    Orderside should denote buy or sell, for buying and selling (if open position) /shorting (if no open position), respectively
+    Shorting is only possible for US equities with non-fractionable qty
+    Notional should denote the usd value of the trade, only for market orders
+    Qty should denote the amount of shares or tokens to trade
+    Takeprofit and stoploss denote market prices, are only supported for US Equities
+    For stock limit orders, fractional orders will default to 'day' orders, and non-fractional orders will default to 'good until close' orders
+    Extended_hours lets us equity limit orders trade in the pre and post market sessions, us equity day orders that cannot trade in the current session are rejected before submission,
+    whole share good until cancelled orders are accepted in every session and queued until the next open
+    Client_order_id optionally tags the order with a unique id, the server rejects a second order with the same id
+    Max_impact sets the highest expected market impact (0.001 for 0.1%) of crypto market orders, estimated from the order book
+    Impact_action sets what happens above it: 'warn' submits anyway, 'limit' submits a limit order capped at max_impact from the best price
+    (a notional becomes the qty it buys at the estimated average price),
+    'slice' submits the order as consecutive market orders each within max_impact, sized from a fresh book every second, and
+    returns the list of their ids (at most 10 slices, the last one takes the rest)
+    Route='auto' trades crypto cross pairs (ETH/BTC) through USD or USDT when that is cheaper after spreads and fees,
+    only for market orders with qty, the routed legs are submitted in sequence and the list of their ids is returned
+    Account is the key of the account trading the order (see accounts.py), None trades on the default account
+    """
+    #Logic for all exception handling prior to submitting order
+    reason = validate_order(ticker, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours, account)
+    if reason:
+        log.warning("order_rejected", ticker=ticker, reason=reason)
         return
     
-    if ticker in list_of_us_equities:
-        if takeprofit or stoploss:
-            if qty and isinstance(qty, float):
-                print("For non-simple orders with take profit/stop loss, qty must be non-fractional")
-                return
-            if notional:
-                print("For non-simple orders with take profit/stop loss, non-fractional qty must be provided not notional")
-                return
-    
-    if ticker in list_of_us_equities:
-        #Fractional orders for us equities default to 'day' orders
-        if notional or isinstance(qty, float):
-            time_in_force = "day"
-        #Non-fractional orders for us equities default to 'good until close' orders
-        else:
-            time_in_force = "gtc"
-    
-    #Logic for market orders
-    if ordertype == 'market':
-        if ticker in list_of_us_equities:
-            #If trading stocks at market price with take profit and stop loss
-            if takeprofit and stoploss:
-                response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request, 
-                                             json={
-                                                 "symbol": ticker,
-                                                 "qty": qty,
-                                                 "side": orderside, 
-                                                 "type": ordertype,
-                                                 "time_in_force": time_in_force,
-                                                 "order_class": "bracket",
-                                                 "take_profit": {"limit_price": takeprofit},
-                                                 "stop_loss": {"stop_price": stoploss}
-                                             }
-                )
-            elif (takeprofit is None and stoploss is not None) or (takeprofit is not None and stoploss is None):
-                #If trading stocks at market price with take profit
-                if takeprofit:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "oto",
-                                                     "take_profit": {"limit_price": takeprofit}
-                                                 }
-                    )
-                #If trading stocks at market price with stop loss
-                else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "oto",
-                                                     "stop_loss": {"stop_price": stoploss}
-                                                 }
-                    )
-            #If trading stocks at market price without take profit or stop loss
-            else:
-                if notional:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "notional": notional,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "simple"
-                                                 }
-                    )
-                else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "simple"
-                                                 }
-                    )
-        #If trading crypto at market price
-        else:
-            if takeprofit is None and stoploss is None:
-                if notional:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "notional": notional,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": "gtc",
-                                                     "order_class": "simple"
-                                                 }
-                    )
-                else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "time_in_force": "gtc",
-                                                     "order_class": "simple"
-                                                 }
-                    )
-            else:
-                print("Crypto orders do not support take profit and stop loss")
-                return
-        
-        orders[ticker] = response
-        submission_time = response['submitted_at']
-        if '/BTC' in ticker:
-            prices[submission_time] = {
-                                     "bid/ask at fill": float(return_latest_price(ticker, orderside)), #store live bid/ask price for slippage calculations
-                                     "bid/ask at submission": float(return_latest_price(ticker, orderside)), #store live bid/ask price for trading fee computation
-                                     "BTC/USD at submission": float(return_latest_price('BTC/USD', orderside)) #store live btc/usd price for trading fee computation 
-            } 
+    if max_impact is not None and ordertype == 'market' and ticker in crypto_pairs:
+        impact = None
+        if order_books is None:
+            log.warning("market_impact_unavailable", ticker=ticker, reason="numpy is not installed")
         else:
-            prices[submission_time] = {
-                                     "bid/ask at fill": float(return_latest_price(ticker, orderside)), 
-                                     "bid/ask at submission": float(return_latest_price(ticker, orderside))
-            } 
-        return response['id']
+            #the estimate only guards the order, without a usable book the order is submitted as is
+            try:
+                impact = order_books.estimate_impact(ticker, orderside, qty, notional)
+            except Exception as e:
+                log.warning("market_impact_unavailable", ticker=ticker, reason=str(e))
+            if impact is not None and impact['best_price'] is None:
+                log.warning("market_impact_unavailable", ticker=ticker, reason=f"the {orderside} side of the order book is empty")
+                impact = None
+        if impact is not None and (impact['insufficient_depth'] or impact['impact'] > max_impact):
+            log.warning("market_impact_exceeded", ticker=ticker, impact=impact['impact'], max_impact=max_impact, insufficient_depth=impact['insufficient_depth'])
+            if impact_action == 'limit':
+                ordertype = 'limit'
+                limitprice = impact_limit_price(ticker, orderside, impact['best_price'], max_impact)
+                if notional: #limit orders take a qty, the qty the notional buys at the estimated average price
+                    qty = round(impact['filled_qty'], 9)
+                    notional = None
+                log.info("order_converted_to_limit", ticker=ticker, limitprice=limitprice)
+            elif impact_action == 'slice':
+                return submit_sliced_trade(ticker, orderside, max_impact, notional, qty, client_order_id, account=account)
+    
+    if route == 'auto' and ordertype == 'market' and qty and ticker in crypto_pairs and not ticker.endswith('/USD'):
+        routes = conversion_graph.routes(ticker, orderside, qty, tier_fee('market', monthly_crypto_volume(account, wait=False)))
+        if len(routes[0]["legs"]) > 1:
+            direct = next(candidate for candidate in routes if len(candidate["legs"]) == 1)
+            log.info("order_routed", ticker=ticker, legs=[leg[0] for leg in routes[0]['legs']], saving_usd=direct['cost_usd'] - routes[0]['cost_usd'])
+            return submit_routed_trade(routes[0], client_order_id, account)
+    
+    return submit_new_trade(ticker, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, client_order_id, extended_hours, account=account)
+
+def open_new_trades(basket, concurrency=4):
+    """
+    Opens every trade of basket, a list of open_new_trade keyword argument dicts whose 'account' key picks the account,
+    concurrently across accounts, so one account held back by its rate limit does not delay the others
+    Returns the results of open_new_trade in basket order, exceptions in place of failed trades
+    """
+    return accounts.fan_out([(trade.get('account'), trade) for trade in basket],
+                            lambda account, trade: open_new_trade(**trade), concurrency)
+
+def impact_limit_price(ticker, orderside, best_price, max_impact):
+    #round towards the best price so the limit stays within max_impact
+    increment = crypto_price_increments.get(ticker, 1e-9)
+    if orderside == 'buy':
+        return round(math.floor(best_price * (1 + max_impact) / increment) * increment, 9)
+    return round(math.ceil(best_price * (1 - max_impact) / increment) * increment, 9)
+
+def submit_sliced_trade(ticker, orderside, max_impact, notional=None, qty=None, client_order_id=None, slice_interval=1.0, max_slices=10, account=None):
+    """
+    Splits a crypto market order into consecutive market orders each expected to stay within max_impact
+    Every slice is sized from a fresh order book taken slice_interval seconds after the previous slice, to let the book
+    replenish, so the caller's thread is held about slice_interval seconds per slice. Slice max_slices takes whatever
+    is left, as does a slice that cannot be estimated. Returns the list of order ids
+    """
+    precision = 9 if qty is not None else 2
+    remaining = qty if qty is not None else notional
+    order_ids = []
+    for i in range(max_slices):
+        if i:
+            time.sleep(slice_interval)
+        #the qty within max_impact on the current book, as notional for notional orders
+        try:
+            if i:
+                order_books.refresh([ticker])
+            capacity = order_books.max_qty(ticker, orderside, max_impact)
+            if qty is None and capacity > 0:
+                capacity = capacity * order_books.estimate_impact(ticker, orderside, qty=capacity)['avg_price']
+        except Exception as e:
+            log.warning("market_impact_unavailable", ticker=ticker, reason=str(e))
+            capacity = None
+        amount = round(capacity, precision) if capacity else 0
+        last = i == max_slices - 1 or amount <= 0 or amount >= remaining
+        if last:
+            amount = remaining
+            if i == max_slices - 1 and capacity and capacity < remaining:
+                log.warning("order_slices_capped", ticker=ticker, max_slices=max_slices, last_slice=remaining)
+        order_ids.append(submit_new_trade(ticker, 'market', orderside,
+                                          notional=amount if qty is None else None,
+                                          qty=amount if qty is not None else None,
+                                          client_order_id=f"{client_order_id}-{i}" if client_order_id else None, account=account))
+        remaining = round(remaining - amount, precision)
+        if last or remaining <= 0:
+            break
+    log.info("order_sliced", ticker=ticker, slices=len(order_ids))
+    return order_ids
+
+def submit_routed_trade(route, client_order_id=None, account=None):
+    order_ids = []
+    for i, (pair, orderside, amount) in enumerate(route["legs"]):
+        order_ids.append(submit_new_trade(pair, 'market', orderside,
+                                          notional=round(amount["notional"], 2) if "notional" in amount else None,
+                                          qty=round(amount["qty"], 9) if "qty" in amount else None,
+                                          client_order_id=f"{client_order_id}-{i}" if client_order_id else None, account=account))
+    return order_ids
+
+@correlated
+def submit_new_trade(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, client_order_id=None, extended_hours=False, snapshot_prices=True, account=None):
+    """
+    Submits an order already checked by validate_order, returns the order id
+    Snapshot_prices stores the bid/ask prices used by the fee computations, bulk submissions may skip it to save requests
+    """
+    order_data = build_order(ticker, asset_class_of(ticker), ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours, client_order_id)
+    response = post_order(order_data, account)
     
+    orders[ticker] = response
+    accounts.get(account).orders[ticker] = response
+    if not snapshot_prices:
+        return response['id']
+    submission_time = response['submitted_at']
+    latest_price = float(return_latest_price(ticker, orderside))
+    #market orders store the live bid/ask for slippage calculations, limit orders their limit price
+    prices[submission_time] = {
+                             "bid/ask at fill": latest_price if ordertype == 'market' else limitprice,
+                             "bid/ask at submission": latest_price #store live bid/ask price for trading fee computation
+    }
+    if '/BTC' in ticker:
+        prices[submission_time]["BTC/USD at submission"] = conversion_graph.usd_rate('BTC', orderside) #store live btc/usd price for trading fee computation
+    return response['id']
     
-    #Logic for limit orders
-    else:
-        if ticker in list_of_us_equities:
-            #If trading stocks with limit orders plus take profit and stop loss
-            if takeprofit and stoploss:
-                response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                             json={
-                                                 "symbol": ticker,
-                                                 "qty": qty,
-                                                 "side": orderside,
-                                                 "type": ordertype,
-                                                 "limit_price": limitprice,
-                                                 "time_in_force": time_in_force,
-                                                 "order_class": "bracket",
-                                                 "take_profit": {"limit_price": takeprofit},
-                                                 "stop_loss": {"stop_price": stoploss}
-                                             }
-                )
-            elif (takeprofit is None and stoploss is not None) or (takeprofit is not None and stoploss is None):
-                #If trading stocks with limit orders plus take profit
-                if takeprofit:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "oto",
-                                                     "take_profit": {"limit_price": takeprofit}
-                                                 }
-                    )
-                #If trading stocks with limit orders and stop loss
-                else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time-in_force": time_in_force,
-                                                     "order_class": "oto",
-                                                     "stop_loss": {"stop_price": stoploss}
-                                                 }
-                    )
-            #If trading stocks with limit orders without take profit and stop loss
+
+# (upper bound of 30 day volume in usd, fee) pairs, the last tier has no upper bound
+taker_fee_tiers = [(100000, 0.0025), (500000, 0.0022), (1000000, 0.002), (10000000, 0.0018),
+                   (25000000, 0.0015), (50000000, 0.0013), (100000000, 0.0012), (None, 0.001)]
+maker_fee_tiers = [(100000, 0.0015), (500000, 0.0012), (1000000, 0.001), (10000000, 0.0008),
+                   (25000000, 0.0005), (50000000, 0.0002), (100000000, 0.0002), (None, 0)]
+
+def tier_fee(order_type, monthly_trading_volume):
+    # market orders pay taker fees, limit orders pay maker fees
+    fee_tiers = taker_fee_tiers if order_type == 'market' else maker_fee_tiers
+    for upper_bound, fee in fee_tiers:
+        if upper_bound is None or monthly_trading_volume <= upper_bound:
+            return fee
+
+def fetch_orders(params, account=None):
+    return accounts.get(account).get("/v2/orders", params=params)
+
+volume_cache_ttl = 300
+
+@profiled
+def monthly_crypto_volume(account=None, wait=True):
+    """
+    Usd volume of crypto orders of the account over the last 30 days, which sets its trading fee tier
+    Cached for volume_cache_ttl seconds so repeated fee computations do not re-download the order history
+    Wait=False returns an expired volume right away and refreshes it in the background (it only blocks when there is none yet)
+    """
+    account = accounts.get(account)
+    with account.cache_lock:
+        volume, fetched_at = account.cache.get("monthly_crypto_volume", (None, 0.0))
+        expired = time.monotonic() - fetched_at >= volume_cache_ttl
+        refreshing = account.cache.get("monthly_crypto_volume_refreshing")
+        start_refresh = volume is not None and expired and not wait and refreshing is None
+        if start_refresh:
+            account.cache["monthly_crypto_volume_refreshing"] = threading.Event()
+    if volume is not None and (not expired or not wait):
+        if start_refresh:
+            threading.Thread(target=refresh_monthly_crypto_volume, args=(account,), daemon=True).start()
+        return volume
+    if volume is None and refreshing is not None:
+        #the first download is already running (warm_monthly_crypto_volume), wait for it instead of downloading twice
+        refreshing.wait()
+        with account.cache_lock:
+            volume, fetched_at = account.cache.get("monthly_crypto_volume", (None, 0.0))
+        if volume is not None:
+            return volume
+    return refresh_monthly_crypto_volume(account)
+
+def warm_monthly_crypto_volume(account=None):
+    """Starts the first download of the volume of the account in the background, unless it is cached or already downloading"""
+    account = accounts.get(account)
+    with account.cache_lock:
+        if "monthly_crypto_volume" in account.cache or "monthly_crypto_volume_refreshing" in account.cache:
+            return
+        account.cache["monthly_crypto_volume_refreshing"] = threading.Event()
+    threading.Thread(target=refresh_monthly_crypto_volume, args=(account,), daemon=True).start()
+
+def refresh_monthly_crypto_volume(account):
+    """Downloads the order history of the account without holding its cache lock, so readers of other accounts never wait on it"""
+    try:
+        monthly_trading_volume = crypto_volume(account, timedelta(days=30))
+        with account.cache_lock:
+            account.cache["monthly_crypto_volume"] = (monthly_trading_volume, time.monotonic())
+        return monthly_trading_volume
+    finally:
+        with account.cache_lock:
+            refreshing = account.cache.pop("monthly_crypto_volume_refreshing", None)
+        if refreshing is not None:
+            refreshing.set()
+
+def crypto_volume(account, period):
+    """Usd volume of crypto orders of the account over the last period"""
+    #every page of the period in one window paged serially, a single request unless there is more than one page
+    #of orders (parallel windows only pay off for the long ranges of backfill.py)
+    order_store = OrderStore()
+    now = datetime.now(timezone.utc)
+    backfill_orders(lambda params: fetch_orders(params, account.key), order_store, now - period, now, window=period, concurrency=1)
+    all_orders_last_month = order_store.records()
+
+    monthly_trading_volume = 0
+    for order in all_orders_last_month:
+        if order['symbol'] in crypto_pairs:
+            if '/BTC' in order['symbol']:
+                traded_token = order['symbol'].split('/')[0]
+                base_token = order['symbol'].split('/')[1]
+                orderside = order['side']
+                order_volume = float(order['qty']) if order['qty'] else float(order['notional'])
+                if order['qty']:
+                    order_volume = order_volume * conversion_graph.usd_rate(traded_token, orderside)
+                if order['notional']:
+                    order_volume = order_volume * conversion_graph.usd_rate(base_token, orderside)
+                monthly_trading_volume += order_volume
             else:
-                if notional:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "notional": notional,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "simple"
-                                                 }
-                    )
-                else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time_in_force": time_in_force,
-                                                     "order_class": "simple"
-                                                 }
-                    )
-        #If trading crypto with limit orders
-        else:
-            if takeprofit is None and stoploss is None:
-                if notional:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "notional": notional,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time_in_force": "gtc",
-                                                     "order_class": "simple"
-                                                 }
-                    )
+                order_volume = float(order['qty']) if order['qty'] else float(order['notional'])
+                if order['qty']:
+                    traded_token = order['symbol'].split('/')[0]
+                    orderside = order['side']
+                    order_volume = order_volume * conversion_graph.usd_rate(traded_token, orderside)
+                    monthly_trading_volume += order_volume
                 else:
-                    response = safe_post_request(f"{trading_url}/v2/orders", headers=headers_post_request,
-                                                 json={
-                                                     "symbol": ticker,
-                                                     "qty": qty,
-                                                     "side": orderside,
-                                                     "type": ordertype,
-                                                     "limit_price": limitprice,
-                                                     "time_in_force": "gtc",
-                                                     "order_class": "simple"
-                                                 }
-                    )
-            else:
-                print("Crypto orders do not support take profit and stop loss")
-                return
-        
-        orders[ticker] = response
-        submission_time = response['submitted_at']
-        if '/BTC' in ticker:
-            prices[submission_time] = {
-                                     "bid/ask at fill": limitprice, # store limit price for slippage calculations
-                                     "bid/ask at submission": float(return_latest_price(ticker, orderside)), # store live bid/ask price for trading fee computations
-                                     "BTC/USD at submission": float(return_latest_price('BTC/USD', orderside)) # store live BTC/USD price for trading fee computations
-            } 
-        else:
-            prices[submission_time] = {
-                                     "bid/ask at fill": limitprice, 
-                                     "bid/ask at submission": float(return_latest_price(ticker, orderside))
-            } 
-        return response['id']
-    
+                    monthly_trading_volume += order_volume
+    return monthly_trading_volume
+
+#routed orders and fill costs read the fee tier without waiting, the first volume of each account is downloaded at import
+for registered_account in accounts:
+    warm_monthly_crypto_volume(registered_account.key)
 
-def fee_simulator(order_id): 
+@profiled
+def fee_simulator(order_id, account=None): 
     
     #Check if order has filled status
-    latest_order = safe_get_request(f"{trading_url}/v2/orders/{order_id}", headers=headers_get_request)
+    latest_order = accounts.get(account).get(f"/v2/orders/{order_id}")
     if latest_order['status'] != "filled":
-        print("Order not yet filled, fees calculated upon fill")
+        log.info("fees_pending", order_id=order_id, status=latest_order['status'], reason="Order not yet filled, fees calculated upon fill")
         return
     
     avg_fill_price = float(latest_order['filled_avg_price'])
@@ -405,82 +433,12 @@ def fee_simulator(order_id):
     slippage_cost = abs(market_price_at_fill - avg_fill_price) * filled_qty
     if '/BTC' in latest_order['symbol']:
         base_token = latest_order['symbol'].split('/')[1]
-        usd_pair = f"{base_token}/USD"
         orderside = latest_order['side'] 
-        slippage_cost = slippage_cost * float(return_latest_price(usd_pair, orderside)) #convert slippage cost from BTC amount to USD amount if necessary
+        slippage_cost = slippage_cost * conversion_graph.usd_rate(base_token, orderside) #convert slippage cost from BTC amount to USD amount if necessary
     
     #calculate trading tier fee cost for crypto, stock trading has no trading fees
-    if latest_order['symbol'] in list_of_crypto_pairs:
-        one_month_ago = datetime.now() - timedelta(days=30)
-        one_month_ago = one_month_ago.strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
-        all_orders_last_month = safe_get_request(f"{trading_url}/v2/orders", headers=headers_get_request, 
-                                                 params={
-                                                     "status": "all",
-                                                     "after": one_month_ago,
-                                                     "direction": "desc"
-                                                }
-        )
-    
-        monthly_trading_volume = 0
-        for order in all_orders_last_month:
-            if order['symbol'] in list_of_crypto_pairs:
-                if '/BTC' in order['symbol']:
-                    traded_token = order['symbol'].split('/')[0]
-                    base_token = order['symbol'].split('/')[1]
-                    main_usd_pair = f"{traded_token}/USD"
-                    base_usd_pair = f"{base_token}/USD"
-                    orderside = order['side']
-                    order_volume = float(order['qty']) if order['qty'] else float(order['notional'])
-                    if order['qty']:
-                        order_volume = order_volume * float(return_latest_price(main_usd_pair, orderside))
-                    if order['notional']:
-                        order_volume = order_volume * float(return_latest_price(base_usd_pair, orderside)) #store live BTC/USD price instead of calling it everytime
-                    monthly_trading_volume += order_volume
-                else:
-                    order_volume = float(order['qty']) if order['qty'] else float(order['notional'])
-                    if order['qty']:
-                        traded_pair = order['symbol']
-                        orderside = order['side']
-                        order_volume = order_volume * float(return_latest_price(traded_pair, orderside))
-                        monthly_trading_volume += order_volume
-                    else:
-                        monthly_trading_volume += order_volume
-    
-        if order_type == 'market': # assign taker trading tier fees based on monthly trading volumes
-            if 0 <= monthly_trading_volume <= 100000:
-                trading_tier_fee = 0.0025
-            elif 100000 <= monthly_trading_volume <= 500000:
-                trading_tier_fee = 0.0022
-            elif 500000 <= monthly_trading_volume <= 1000000:
-                trading_tier_fee = 0.002
-            elif 1000000 <= monthly_trading_volume <= 10000000:
-                trading_tier_fee = 0.0018
-            elif 10000000 <= monthly_trading_volume <= 25000000:
-                trading_tier_fee: 0.0015
-            elif 25000000 <= monthly_trading_volume <= 50000000:
-                trading_tier_fee = 0.0013
-            elif 50000000 <= monthly_trading_volume <= 100000000:
-                trading_tier_fee = 0.0012
-            else:
-                trading_tier_fee = 0.001
-    
-        if order_type == 'limit': # assign maker trading tier fees based on monthly trading volumes
-            if 0 <= monthly_trading_volume <= 100000:
-                trading_tier_fee = 0.0015
-            elif 100000 <= monthly_trading_volume <= 500000:
-                trading_tier_fee = 0.0012
-            elif 500000 <= monthly_trading_volume <= 1000000:
-                trading_tier_fee = 0.001
-            elif 1000000 <= monthly_trading_volume <= 10000000:
-                trading_tier_fee = 0.0008
-            elif 10000000 <= monthly_trading_volume <= 25000000:
-                trading_tier_fee: 0.0005
-            elif 25000000 <= monthly_trading_volume <= 50000000:
-                trading_tier_fee = 0.0002
-            elif 50000000 <= monthly_trading_volume <= 100000000:
-                trading_tier_fee = 0.0002
-            else:
-                trading_tier_fee = 0
+    if latest_order['symbol'] in crypto_pairs:
+        trading_tier_fee = tier_fee(order_type, monthly_crypto_volume(account))
     
         if '/BTC' in latest_order['symbol']:
             base_token = latest_order['symbol'].split('/')[1]
@@ -6,13 +6,17 @@ Created on Tue Mar 12 03:56:31 2024
 """
 
 from alpaca.trading.client import TradingClient
-from alpaca.trading.requests import GetAssetsRequest, MarketOrderRequest, TakeProfitRequest, StopLossRequest, LimitOrderRequest
-from alpaca.trading.enums import AssetClass, OrderSide, TimeInForce, OrderClass, OrderType, OrderStatus
+from alpaca.trading.requests import GetAssetsRequest
+from alpaca.trading.enums import AssetClass, OrderSide, OrderStatus
 from alpaca.data.historical import CryptoHistoricalDataClient, StockHistoricalDataClient
 from alpaca.data.requests import CryptoLatestQuoteRequest, StockLatestQuoteRequest
 from alpaca.common.exceptions import APIError
 import time
 from config_alpaca import API_KEY, SECRET_KEY
+from market_clock import MarketClock, session_rejection
+from event_log import log, correlated
+from order_core import check_order, build_order, time_in_force
+from transports import AlpacaPyTransport
 
 trading_client = TradingClient(api_key=API_KEY, secret_key=SECRET_KEY, paper=True)
 crypto_data_client = CryptoHistoricalDataClient()
@@ -20,7 +24,11 @@ stock_data_client = StockHistoricalDataClient(api_key=API_KEY, secret_key=SECRET
 
 account = trading_client.get_account()
 buying_power = account.buying_power
-print(f'${account.buying_power} is available as buying power')
+log.info('buying_power', buying_power=account.buying_power)
+
+market_clock = MarketClock(lambda path, params: trading_client.get(path, params))
+#orders are submitted through order_transport, swap it for another transport (MockTransport for dry runs)
+order_transport = AlpacaPyTransport(trading_client)
 
 def list_of_us_equities():
     params = GetAssetsRequest(asset_class=AssetClass.US_EQUITY)
@@ -33,7 +41,7 @@ def list_of_crypto_pairs():
     return assets
 
 def return_latest_price(ticker, orderside):
-    if ticker in list_of_us_equities():
+    if '/' not in ticker: #crypto pairs are the only tickers with a slash
         params = StockLatestQuoteRequest(symbol_or_symbols=ticker)
         latest_quote = stock_data_client.get_stock_latest_quote(params)
     else:
@@ -47,228 +55,67 @@ def return_latest_price(ticker, orderside):
 
 orders = {}
     
-def open_new_trade(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None):
+@correlated
+def open_new_trade(ticker:str, ordertype:str, orderside:str, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, extended_hours=False, client_order_id=None):
     """
     Function for opening new trades, supported markets: US equities and crytpocurrencies
     Ticker for equities should be all caps (AAPL), for cryptos should represent the pair in all caps (BTC/USDT)
     Ordertype should denote market or limit, for market and limit orders respectively
     Orderside should denote buy or sell, for buying and selling (if open position) /shorting (if no open position), respectively
-    Notional should denote the usd value of the trade, only use for stock market orders
-    Qty should denote the amount of shares or tokens to trade, only use for stock limit orders (non-fractiona only) and crypto
+    Notional should denote the usd value of the trade, only for market orders
+    Qty should denote the amount of shares or tokens to trade, orders with take profit/stop loss need non-fractional qty
     Takeprofit and stoploss denote market prices, are only supported for US Equities
+    Extended_hours lets us equity limit orders trade in the pre and post market sessions, us equity day orders that cannot trade in the current session are rejected before submission,
+    whole share good until cancelled orders are accepted in every session and queued until the next open
+    Client_order_id optionally tags the order with a unique id, the server rejects a second order with the same id
     """
     #Logic for all exception handling prior to submitting order
-    if notional is None and qty is None:
-        print('Either notional or qty must be passed')
-        return
-    
     try:
         asset = trading_client.get_asset(ticker)
     except Exception as e:
-        print(f'Asset {ticker} is not supported: {e}')
+        log.warning('order_rejected', ticker=ticker, reason=f'Asset {ticker} is not supported: {e}')
         return
     if not asset.tradable:
-        print(f'Asset {ticker} is not tradable')
+        log.warning('order_rejected', ticker=ticker, reason=f'Asset {ticker} is not tradable')
         return
+    asset_class = 'crypto' if asset.asset_class == AssetClass.CRYPTO else 'us_equity'
     
-    if orderside == 'buy':
-        order_side = OrderSide.BUY
-    elif orderside == 'sell':
-        order_side = OrderSide.SELL
-    else:
-        print(f'Invalid input {orderside}')
+    reason = check_order(asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours)
+    if reason:
+        log.warning('order_rejected', ticker=ticker, reason=reason)
         return
     
-    if ordertype == 'market':
-        order_type = OrderType.MARKET
-    elif ordertype == 'limit':
-        order_type = OrderType.LIMIT
-    else:
-        print(f'Invalid input {orderside}')
+    if notional and notional > float(buying_power):
+        log.warning('order_rejected', ticker=ticker, reason=f'Notional: {notional} exceeds available funds: {buying_power}')
         return
     
-    if notional and qty:
-        print('Both notional and qty cannot be passed')
-        return
-        
-    if ticker in list_of_crypto_pairs():
-        if qty:  
-            traded_token = ticker.split('/')[0]
-            usd_pair = f'{traded_token}/USD'                             
-            dollar_amount = qty * float(return_latest_price(usd_pair, orderside))
-            if dollar_amount > float(buying_power):
-                print(f'Amount converted to dollars: {dollar_amount} exceeds available funds: {buying_power}')
-                return
-        else:
-            print('For crypto trades qty must be provided not notional')
+    if qty:
+        usd_pair = f"{ticker.split('/')[0]}/USD" if asset_class == 'crypto' else ticker
+        dollar_amount = qty * float(return_latest_price(usd_pair, orderside))
+        if dollar_amount > float(buying_power):
+            log.warning('order_rejected', ticker=ticker, reason=f'Amount converted to dollars: {dollar_amount} exceeds available funds: {buying_power}')
             return
     
-    if ticker in list_of_us_equities() and ordertype == 'market':
-        if notional:
-            if notional > float(buying_power):
-                print(f'Notional: {notional} exceeds available funds: {buying_power}')
-                return
-        else:
-            print('For us equities market orders notional must be provided not qty')
+    if asset_class == 'us_equity':
+        session_reason = session_rejection(market_clock, ordertype, extended_hours, tif=time_in_force(asset_class, notional, qty, extended_hours))
+        if session_reason:
+            log.warning('order_rejected', ticker=ticker, reason=session_reason)
             return
-        
-    if ticker in list_of_us_equities() and ordertype == 'limit':
-        if qty and type(qty) == int:
-            dollar_amount = qty * float(return_latest_price(ticker, orderside))
-            if dollar_amount > float(buying_power):
-                print(f'Amount converted to dollars: {dollar_amount} exceeds available funds:{buying_power}')
-                return
-        else:
-            print('For us equities limit orders only integer, non-fractional qty must be provided not notional or fractional qty')
-            return
-    
-    if ordertype == 'limit' and limitprice is None:
-        print('Limit price must be included with limit order type')
-        return
     
-    #Logic for market orders
-    if ordertype == 'market':
-        if ticker in list_of_us_equities():
-            #If trading stocks at market price with take profit and stop loss
-            if takeprofit and stoploss:
-                market_order_data = MarketOrderRequest(
-                    symbol=ticker,
-                    notional=notional,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.DAY,
-                    order_class=OrderClass.BRACKET,
-                    take_profit=TakeProfitRequest(takeprofit),
-                    stop_loss=StopLossRequest(stoploss)
-                )
-            elif (takeprofit is None and stoploss is not None) or (takeprofit is not None and stoploss is None):
-                #If trading stocks at market price with take profit
-                if takeprofit:
-                    market_order_data = MarketOrderRequest(
-                        symbol=ticker,
-                        notional=notional,
-                        side=order_side,
-                        type=order_type,
-                        time_in_force=TimeInForce.DAY,
-                        order_class=OrderClass.OTO,
-                        take_profit=TakeProfitRequest(takeprofit)
-                    )
-                #If trading stocks at market price with stop loss
-                else:
-                    market_order_data = MarketOrderRequest(
-                        symbol=ticker,
-                        notional=notional,
-                        side=order_side,
-                        type=order_type,
-                        time_in_force=TimeInForce.DAY,
-                        order_class=OrderClass.OTO,
-                        stop_loss=StopLossRequest(stoploss)
-                    )
-            #If trading stocks at market price without take profit or stop loss
-            else:
-                market_order_data = MarketOrderRequest(
-                    symbol=ticker,
-                    notional=notional,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.DAY,
-                )
-        #If trading crypto at market price
-        else:
-            if takeprofit is None and stoploss is None:
-                market_order_data = MarketOrderRequest(
-                    symbol=ticker,
-                    qty=qty,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.GTC
-                )
-            else:
-                print('Crypto orders do not support take profit and stop loss')
-                return
-        
-        market_order = trading_client.submit_order(order_data=market_order_data)
-        orders[ticker] = market_order
-        return market_order.id
-    
-    #Logic for limit orders
-    else:
-        if ticker in list_of_us_equities():
-            #If trading stocks with limit orders plus take profit and stop loss
-            if takeprofit and stoploss:
-                limit_order_data = LimitOrderRequest(
-                    symbol=ticker,
-                    limit_price=limitprice,
-                    qty=qty,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.DAY,
-                    order_class=OrderClass.BRACKET,
-                    take_profit=TakeProfitRequest(takeprofit),
-                    stop_loss=StopLossRequest(stoploss)
-                )
-            elif (takeprofit is None and stoploss is not None) or (takeprofit is not None and stoploss is None):
-                #If trading stocks with limit orders plus take proft
-                if takeprofit:
-                    limit_order_data = LimitOrderRequest(
-                        symbol=ticker,
-                        limit_price=limitprice,
-                        qty=qty,
-                        side=order_side,
-                        type=order_type,
-                        time_in_force=TimeInForce.DAY,
-                        order_class=OrderClass.OTO,
-                        take_profit=TakeProfitRequest(takeprofit)
-                    )
-               #If trading stocks with limit orders plus stop loss
-                else:
-                    limit_order_data = LimitOrderRequest(
-                        symbol=ticker,
-                        limit_price=limitprice,
-                        qty=qty,
-                        side=order_side,
-                        type=order_type,
-                        time_in_force=TimeInForce.DAY,
-                        order_class=OrderClass.OTO,
-                        stop_loss=StopLossRequest(stoploss)
-                    )
-            #If trading stocks with limit orders without take profit and stop loss
-            else:
-                limit_order_data = LimitOrderRequest(
-                    symbol=ticker,
-                    limit_price=limitprice,
-                    qty=qty,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.DAY
-                )
-        #If trading crypto with limit orders
-        else:
-            if takeprofit is None and stoploss is None:
-                limit_order_data = LimitOrderRequest(
-                    symbol=ticker,
-                    limit_price=limitprice,
-                    qty=qty,
-                    side=order_side,
-                    type=order_type,
-                    time_in_force=TimeInForce.GTC
-                )
-            else:
-                print('Crypto orders do not support take profit and stop loss')
-                return
-        
-        limit_order = trading_client.submit_order(order_data=limit_order_data)
-        orders[ticker] = limit_order
-        return limit_order.id
+    order_data = build_order(ticker, asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours, client_order_id)
+    order = order_transport.submit_order(order_data)
+    log.info('order_submitted', order_id=order['id'], symbol=ticker, side=orderside, type=ordertype, status=order.get('status'))
+    orders[ticker] = order
+    return order['id']
 
 #Obtain fees: approach through positions    
 def fee_simulator(order):
     #Check if order has filled status
     if order.status == OrderStatus.EXPIRED:
-        print("Order expired without fill, fees calculated upon fill")
+        log.info('fees_pending', order_id=str(order.id), status=order.status, reason='Order expired without fill, fees calculated upon fill')
         return
     if order.status != OrderStatus.FILLED and order.status != OrderStatus.PARTIALLY_FILLED:
-        print("Order not yet filled, fees calculated upon fill")
+        log.info('fees_pending', order_id=str(order.id), status=order.status, reason='Order not yet filled, fees calculated upon fill')
         return
     
     try:
@@ -284,7 +131,7 @@ def fee_simulator(order):
             ticker = ticker.replace('USDC', 'USD')
         position = trading_client.get_open_position(ticker)
     except APIError:
-        print("Position not found")
+        log.warning('position_not_found', order_id=str(order.id), ticker=ticker)
         return
     
     cost_basis = float(position.cost_basis)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Several accounts driven from one process
+
+Every Account has its own pooled session carrying its keys, its own token bucket (a 429
+answered to one account only pauses that account) and its own cached account state.
+AccountRegistry routes by account key, and fan_out runs a basket spanning accounts on one
+worker pool per account, so an account waiting on its rate limit never holds the
+workers of the others
+
+The API_KEY/SECRET_KEY of config_alpaca are the "default" account, more accounts are added with
+ACCOUNTS = {"sub1": (SUB1_API_KEY, SUB1_SECRET_KEY), ...} in config_alpaca
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit import RateLimiter
+from transports import RequestsTransport
+
+class Account:
+    def __init__(self, key, base_url, api_key, secret_key, requests_per_minute=200, pool_size=10, state_ttl=5.0):
+        self.key = key
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.transport = RequestsTransport(base_url, api_key, secret_key, self.rate_limiter, pool_size)
+        self.state_ttl = state_ttl
+        self.state = None
+        self.state_fetched_at = 0.0
+        self.lock = threading.Lock()
+        self.orders = {} #latest order response by ticker
+        self.cache = {} #values derived from the account's history (its fee tier volume), guarded by cache_lock
+        self.cache_lock = threading.Lock()
+
+    def get(self, path, params=None):
+        return self.transport.request("GET", path, params=params)
+
+    def submit_order(self, order_data):
+        return self.transport.submit_order(order_data)
+
+    def info(self, refresh=False):
+        """The account endpoint's response, cached for state_ttl seconds"""
+        with self.lock:
+            if refresh or self.state is None or time.monotonic() - self.state_fetched_at > self.state_ttl:
+                self.state = self.get("/v2/account")
+                self.state_fetched_at = time.monotonic()
+            return self.state
+
+    def buying_power(self):
+        return float(self.info()['buying_power'])
+
+class AccountRegistry:
+    def __init__(self, base_url, default="default"):
+        self.base_url = base_url
+        self.default = default
+        self.accounts = {}
+
+    @classmethod
+    def from_config(cls, config, base_url, **kwargs):
+        registry = cls(base_url)
+        registry.add("default", config.API_KEY, config.SECRET_KEY, **kwargs)
+        for key, (api_key, secret_key) in getattr(config, "ACCOUNTS", {}).items():
+            registry.add(key, api_key, secret_key, **kwargs)
+        return registry
+
+    def add(self, key, api_key, secret_key, **kwargs):
+        account = Account(key, self.base_url, api_key, secret_key, **kwargs)
+        self.accounts[key] = account
+        return account
+
+    def get(self, key=None):
+        """The account of key, the default account for None"""
+        account = self.accounts.get(self.default if key is None else key)
+        if account is None:
+            raise Exception(f"Unknown account {key}")
+        return account
+
+    def __contains__(self, key):
+        return (self.default if key is None else key) in self.accounts
+
+    def __iter__(self):
+        return iter(self.accounts.values())
+
+    def fan_out(self, basket, call, concurrency=4):
+        """
+        Calls call(account, item) for every (account key, item) of basket, concurrency at a time per account
+        Returns the results in basket order, exceptions in place of failed items
+        """
+        pools = {}
+        futures = []
+        try:
+            for key, item in basket:
+                if key not in self:
+                    futures.append(Exception(f"Unknown account {key}"))
+                    continue
+                account = self.get(key)
+                if account.key not in pools:
+                    pools[account.key] = ThreadPoolExecutor(max_workers=concurrency)
+                futures.append(pools[account.key].submit(call, account, item))
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+        results = []
+        for future in futures:
+            if isinstance(future, Exception):
+                results.append(future)
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def submit_basket(self, basket, concurrency=4):
+        """Submits (account key, order payload) pairs, returns the order responses in order"""
+        return self.fan_out(basket, lambda account, order_data: account.submit_order(order_data), concurrency)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel backfill of the order history
+
+The date range is split into time windows whose pages are fetched concurrently (the
+shared rate limiter keeps every thread within the API limit). Orders are deduplicated
+by id across window and page boundaries, normalized, and streamed to a sink window by
+window: an OrderStore in memory, or a ColumnarFileSink writing parquet or csv
+
+Usage: python backfill.py --start 2024-01-01 --end 2025-01-01 --out orders.parquet
+"""
+
+import argparse
+import contextvars
+import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from event_log import log
+from market_clock import parse_timestamp
+
+try:
+    import pyarrow as pa #optional, pip install pyarrow, only needed for parquet output
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+#normalized record columns and whether they hold numbers
+order_columns = [("id", False), ("client_order_id", False), ("symbol", False), ("asset_class", False), ("side", False),
+                 ("order_type", False), ("order_class", False), ("time_in_force", False), ("status", False),
+                 ("qty", True), ("notional", True), ("filled_qty", True), ("filled_avg_price", True),
+                 ("limit_price", True), ("stop_price", True), ("submitted_at", False), ("filled_at", False)]
+
+def timestamp(moment):
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+
+def normalize(order):
+    record = {}
+    for column, numeric in order_columns:
+        value = order.get(column)
+        record[column] = float(value) if numeric and value is not None else value
+    return record
+
+def fetch_window(fetch, window_start, window_end, page_size=500, status="all"):
+    """
+    Every order of status submitted in the window, page after page, a window_start or window_end of None leaves that side open
+    Orders at page boundaries may be returned twice, callers deduplicate them by id
+    """
+    orders = []
+    after = window_start - timedelta(microseconds=1) if window_start else None #after is exclusive
+    while True:
+        params = {"status": status, "direction": "asc", "limit": page_size}
+        if after:
+            params["after"] = timestamp(after)
+        if window_end:
+            params["until"] = timestamp(window_end)
+        page = fetch(params)
+        orders.extend(page)
+        if len(page) < page_size:
+            return orders
+        #orders submitted in the same instant as the last one may straddle the page, start the next page just before it
+        last_submitted = parse_timestamp(page[-1]['submitted_at'])
+        if after is None or last_submitted - timedelta(microseconds=1) > after:
+            after = last_submitted - timedelta(microseconds=1)
+        else:
+            #a full page submitted in one microsecond would be fetched again forever, the next page starts past that instant
+            log.warning("backfill_page_stalled", submitted_at=page[-1]['submitted_at'], page_size=page_size,
+                        reason="more orders than a page share this timestamp, the ones past the page are skipped")
+            after = last_submitted
+
+def backfill_orders(fetch, sink, start, end=None, window=timedelta(days=7), concurrency=8):
+    """
+    Fetch is called as fetch(params) and should return the orders endpoint response for params.
+    Sink is called with each window's list of new normalized records, returns the number of orders backfilled
+    """
+    end = end or datetime.now(timezone.utc)
+    windows = []
+    window_start = start
+    while window_start < end:
+        windows.append((window_start, min(window_start + window, end)))
+        window_start += window
+
+    seen = set()
+    backfilled = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        #each window runs in a copy of the caller's context, so its requests keep the caller's correlation id and profile
+        futures = [pool.submit(contextvars.copy_context().run, fetch_window, fetch, window_start, window_end) for window_start, window_end in windows]
+        for future in as_completed(futures):
+            records = []
+            for order in future.result():
+                if order['id'] not in seen:
+                    seen.add(order['id'])
+                    records.append(normalize(order))
+            if records:
+                sink(records)
+                backfilled += len(records)
+    return backfilled
+
+class OrderStore:
+    """In memory sink, orders by id"""
+    def __init__(self):
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, records):
+        with self.lock:
+            for record in records:
+                self.orders[record['id']] = record
+
+    def records(self):
+        with self.lock:
+            return list(self.orders.values())
+
+class ColumnarFileSink:
+    """Writes records to a parquet file (one row group per window) or, for any other extension, a csv file"""
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        if path.endswith(".parquet"):
+            if pa is None:
+                raise Exception("pyarrow is required to write parquet files")
+            self.schema = pa.schema([(column, pa.float64() if numeric else pa.string()) for column, numeric in order_columns])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.file = open(path, "w", newline="", encoding="utf-8")
+            self.csv_writer = csv.DictWriter(self.file, fieldnames=[column for column, _ in order_columns])
+            self.csv_writer.writeheader()
+
+    def __call__(self, records):
+        if self.writer is not None:
+            self.writer.write_table(pa.Table.from_pylist(records, schema=self.schema))
+        else:
+            self.csv_writer.writerows(records)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.file.close()
+
+if __name__ == "__main__":
+
+    from HTTP_request_version import trading_url, headers_get_request, safe_get_request
+
+    parser = argparse.ArgumentParser(description="Backfill the order history to a parquet or csv file")
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", help="last day (exclusive), YYYY-MM-DD, defaults to now")
+    parser.add_argument("--out", required=True, help="output file, .parquet or .csv")
+    parser.add_argument("--window-days", type=float, default=7, help="days per window")
+    parser.add_argument("--concurrency", type=int, default=8, help="windows fetched concurrently")
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc)
+    end = datetime.fromisoformat(args.end).replace(tzinfo=timezone.utc) if args.end else None
+    sink = ColumnarFileSink(args.out)
+    started = datetime.now()
+    backfilled = backfill_orders(lambda params: safe_get_request(f"{trading_url}/v2/orders", headers=headers_get_request, params=params),
+                                 sink, start, end, timedelta(days=args.window_days), args.concurrency)
+    sink.close()
+    print(f"Backfilled {backfilled} orders in {(datetime.now() - started).total_seconds():.1f}s to {args.out}")
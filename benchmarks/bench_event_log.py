@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Overhead of logging on the order submit path: synchronous print() against enqueueing
+an event on the background writer. Each is measured on a local file and on a slow
+stream standing in for a terminal or a pipe whose reader falls behind
+
+Usage: python -m benchmarks.bench_event_log
+"""
+
+import os
+import tempfile
+import time
+from event_log import EventLogger, correlation
+
+class SlowStream:
+    """Stream whose flush takes write_delay seconds, like a blocked stdout"""
+    def __init__(self, stream, write_delay=0.0002):
+        self.stream = stream
+        self.write_delay = write_delay
+
+    def write(self, text):
+        self.stream.write(text)
+
+    def flush(self):
+        time.sleep(self.write_delay)
+        self.stream.flush()
+
+def per_call_us(function, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - started) / calls * 1e6
+
+def bench(stream, calls):
+    reason = "Amount converted to dollars {}, exceeds available funds 1000"
+    results = {"print, flushed": per_call_us(lambda i: print(reason.format(i), file=stream, flush=True), calls)}
+    for name, logger in (("event log, text", EventLogger(stream=stream, fmt="text")),
+                         ("event log, json lines", EventLogger(stream=stream, fmt="json")),
+                         ("event log, below level", EventLogger(stream=stream, level="error"))):
+        with correlation("bench"):
+            results[name] = per_call_us(lambda i: logger.warning("order_rejected", ticker="AAPL", reason=reason.format(i)), calls)
+        logger.flush(timeout=120) #drain before the next measurement so writers do not overlap
+    return results
+
+if __name__ == "__main__":
+
+    path = os.path.join(tempfile.mkdtemp(), "events.log")
+    with open(path, "w") as stream:
+        fast = bench(stream, 100000)
+        slow = bench(SlowStream(stream), 5000)
+
+    print(f"{'caller cost per event (us)':<32}{'file':>10}{'slow stream':>14}")
+    for name in fast:
+        print(f"{name:<32}{fast[name]:>10.2f}{slow[name]:>14.2f}")
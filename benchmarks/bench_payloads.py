@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Per-order CPU time of turning an order into a request body, reported separately for
+building the payload with order_core.build_order and for serializing it, with the
+stdlib json module (what requests does with json=) and with transports.dumps (orjson
+when installed)
+
+Usage: python -m benchmarks.bench_payloads
+"""
+
+import json
+import timeit
+from order_core import order_table, build_order
+from transports import dumps, orjson
+from benchmarks.bench_transports import sample_order
+
+def stdlib_body(order_data):
+    return json.dumps(order_data).encode("utf-8")
+
+def per_order_us(function, number=100000):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+if __name__ == "__main__":
+
+    print(f"serializer: {'orjson' if orjson is not None else 'stdlib json (orjson not installed)'}")
+    print(f"{'combination':<32}{'build':>9}{'json':>9}{'dumps':>9}{'speedup':>9}{'build+json':>12}{'build+dumps':>13}")
+    for combination in order_table:
+        order = sample_order(*combination)
+        order["client_order_id"] = "0123456789abcdef"
+        order_data = build_order(**order)
+        assert json.loads(stdlib_body(order_data)) == json.loads(dumps(order_data))
+        build = per_order_us(lambda: build_order(**order))
+        stdlib = per_order_us(lambda: stdlib_body(order_data))
+        fast = per_order_us(lambda: dumps(order_data))
+        print(f"{'/'.join(combination):<32}{build:>8.2f}u{stdlib:>8.2f}u{fast:>8.2f}u{stdlib / fast:>8.1f}x{build + stdlib:>11.2f}u{build + fast:>12.2f}u")
+    print("build: payload construction, json/dumps: serializing the built payload, speedup: json/dumps (us per order)")
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the transports of transports.py: payload construction time for every
+combination of order_table, then round trip latency of submitting orders to a
+local http server answering like the orders endpoint. Transports whose library
+is not installed are skipped
+
+Usage: python -m benchmarks.bench_transports
+"""
+
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from order_core import order_table, build_order
+from transports import MockTransport, RequestsTransport, AsyncTransport, AlpacaPyTransport, requests, aiohttp
+
+def sample_order(asset_class, ordertype, order_class):
+    order = {"ticker": "AAPL" if asset_class == "us_equity" else "ETH/USD", "asset_class": asset_class,
+             "ordertype": ordertype, "orderside": "buy", "qty": 10}
+    if ordertype == "limit":
+        order["limitprice"] = 100.0
+    if order_class in ("oto", "bracket"):
+        order["takeprofit"] = 110.0
+    if order_class == "bracket":
+        order["stoploss"] = 90.0
+    return order
+
+class OrdersHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #keep-alive, so pooled transports reuse their connections
+    disable_nagle_algorithm = True #headers and body would otherwise wait on delayed acks
+    wbufsize = 65536
+
+    def do_POST(self):
+        order_data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        order_data.update({"id": "00000000-0000-0000-0000-000000000000", "client_order_id": "bench", "status": "accepted",
+                           "submitted_at": "2024-01-01T00:00:00Z", "order_type": order_data["type"], "filled_qty": "0",
+                           "filled_avg_price": None})
+        body = json.dumps(order_data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def latency_ms(submit, orders_data):
+    timings = []
+    for order_data in orders_data:
+        started = time.perf_counter()
+        submit(order_data)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.mean(timings), statistics.median(timings), max(timings)
+
+if __name__ == "__main__":
+
+    #payload construction, per combination of the order table
+    builds = 20000
+    print(f"{'payload construction':<36}{'build us':>10}{'json us':>10}")
+    orders_data = []
+    for asset_class, ordertype, order_class in order_table:
+        order = sample_order(asset_class, ordertype, order_class)
+        started = time.perf_counter()
+        for _ in range(builds):
+            order_data = build_order(**order)
+        build_us = (time.perf_counter() - started) / builds * 1e6
+        started = time.perf_counter()
+        for _ in range(builds):
+            json.dumps(order_data)
+        json_us = (time.perf_counter() - started) / builds * 1e6
+        orders_data.append(order_data)
+        print(f"{f'{asset_class} {ordertype} {order_class}':<36}{build_us:>10.2f}{json_us:>10.2f}")
+
+    #round trips against a local server
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OrdersHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    round_trips = orders_data * 25
+
+    transports = {"mock": MockTransport()}
+    if requests is not None:
+        transports["requests, pooled"] = RequestsTransport(base_url, "key", "secret")
+        transports["requests, unpooled"] = type("Unpooled", (), {"submit_order": staticmethod(
+            lambda order_data: requests.post(f"{base_url}/v2/orders", json=order_data, timeout=10).json())})()
+    if aiohttp is not None:
+        transports["async"] = AsyncTransport(base_url, "key", "secret")
+    try:
+        from alpaca.trading.client import TradingClient
+        transports["alpaca-py"] = AlpacaPyTransport(TradingClient("key", "secret", url_override=base_url))
+    except ImportError:
+        pass
+
+    print(f"\n{'round trip of ' + str(len(round_trips)) + ' orders':<36}{'mean ms':>10}{'p50 ms':>10}{'max ms':>10}")
+    for name, transport in transports.items():
+        transport.submit_order(orders_data[0]) #warm up connections
+        mean, median, worst = latency_ms(transport.submit_order, round_trips)
+        print(f"{name:<36}{mean:>10.3f}{median:>10.3f}{worst:>10.3f}")
+    if "async" in transports:
+        started = time.perf_counter()
+        transports["async"].submit_orders(round_trips)
+        print(f"{'async, concurrent basket':<36}{(time.perf_counter() - started) * 1000 / len(round_trips):>10.3f}")
+        transports["async"].close()
+    skipped = [name for name, library in (("requests", requests), ("async", aiohttp)) if library is None]
+    if "alpaca-py" not in transports:
+        skipped.append("alpaca-py")
+    if skipped:
+        print(f"skipped, library not installed: {', '.join(skipped)}")
+    server.shutdown()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk order submission from csv or parquet files
+
+Rows are streamed from the file, validated, and submitted with a bounded number of
+concurrent requests under the API rate limit. Every row gets a line in the results
+file, so a crashed run restarted with the same arguments skips the rows already
+recorded, and rows that were in flight resolve to their existing order through the
+deterministic client order id instead of being submitted twice. Client order ids are
+derived from the file contents, a new file written to the same path gets new ones
+
+Usage: python bulk_orders.py orders.csv --results results.csv --concurrency 8
+Columns are named after the open_new_trade arguments: ticker, ordertype, orderside,
+notional, qty, limitprice, takeprofit, stoploss, and optionally extended_hours (true/false)
+and account (the key of the account trading the row, see accounts.py, empty for the default account)
+"""
+
+import argparse
+import csv
+import hashlib
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from event_log import log, correlation
+from HTTP_request_version import accounts, RequestRejected, validate_order, submit_new_trade
+
+try:
+    import pyarrow.parquet as pq #optional, pip install pyarrow, only needed for parquet files
+except ImportError:
+    pq = None
+
+order_fields = ("ticker", "ordertype", "orderside", "notional", "qty", "limitprice", "takeprofit", "stoploss", "extended_hours", "account")
+number_fields = ("notional", "qty", "limitprice", "takeprofit", "stoploss")
+result_fields = ("row", "client_order_id", "ticker", "status", "order_id", "reason", "validate_ms", "submit_ms")
+
+def parse_number(value):
+    #whole numbers become int ("10", "10.0", or a float64 parquet column), so they are submitted as non-fractional qty
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        value = int(value) if value.lstrip("-").isdigit() else float(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+def read_rows(path, batch_size=1000):
+    """Yields one order dict per row without loading the whole file"""
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise Exception("pyarrow is required to read parquet files")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+
+def parse_order(row):
+    order = {field: row.get(field) for field in order_fields}
+    for field in number_fields:
+        order[field] = parse_number(order[field])
+    for field in ("ticker", "ordertype", "orderside"):
+        order[field] = (order[field] or "").strip()
+    order["ticker"] = order["ticker"].upper()
+    order["ordertype"] = order["ordertype"].lower()
+    order["orderside"] = order["orderside"].lower()
+    order["extended_hours"] = str(order["extended_hours"]).strip().lower() in ("true", "1", "yes")
+    order["account"] = (order["account"] or "").strip() or None
+    return order
+
+def recorded_rows(results_path, run_id):
+    """
+    Rows of this run already in the results file, rows of earlier runs of a rewritten file do not count
+    Failed rows (retries exhausted) are submitted again, the client order id prevents a duplicate order
+    """
+    if not os.path.exists(results_path):
+        return set()
+    with open(results_path, newline="", encoding="utf-8") as f:
+        return {int(result["row"]) for result in csv.DictReader(f)
+                if result["client_order_id"].startswith(f"bulk-{run_id}-") and result["status"] != "failed"}
+
+def find_order_by_client_id(client_order_id, account=None):
+    return accounts.get(account).get("/v2/orders:by_client_order_id", params={"client_order_id": client_order_id})
+
+def process_row(row_number, row, run_id):
+    client_order_id = f"bulk-{run_id}-{row_number}"
+    with correlation(client_order_id):
+        result = submit_row(row_number, row, client_order_id)
+    log.info("bulk_row_processed", **result)
+    return result
+
+def submit_row(row_number, row, client_order_id):
+    result = {"row": row_number, "client_order_id": client_order_id, "ticker": row.get("ticker"),
+              "status": "", "order_id": "", "reason": "", "validate_ms": "", "submit_ms": ""}
+    started = time.perf_counter()
+    try:
+        order = parse_order(row)
+        result["ticker"] = order["ticker"]
+        reason = None if order["account"] in accounts else f"Unknown account {order['account']}"
+    except Exception as e:
+        reason = f"Invalid row: {e}"
+    if not reason:
+        try:
+            reason = validate_order(**order)
+        except Exception as e:
+            #validation reads prices, rates, buying power and the clock, a request failing there is retried on rerun
+            result["validate_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            result["status"] = "failed"
+            result["reason"] = f"Validation failed: {e}"
+            return result
+    result["validate_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    if reason:
+        result["status"] = "rejected"
+        result["reason"] = reason
+        return result
+
+    started = time.perf_counter()
+    try:
+        result["order_id"] = submit_new_trade(**order, client_order_id=client_order_id, snapshot_prices=False)
+        result["status"] = "submitted"
+    except RequestRejected as e:
+        #a row in flight when the previous run crashed was already accepted under this client order id
+        if e.status_code == 422 and "client_order_id" in e.reason:
+            try:
+                result["order_id"] = find_order_by_client_id(client_order_id, order["account"])["id"]
+                result["status"] = "submitted"
+                result["reason"] = "recovered from previous run"
+            except Exception as lookup_error:
+                #the order exists but could not be read back, a rerun recovers it again
+                result["status"] = "failed"
+                result["reason"] = f"Recovery of existing order failed: {lookup_error}"
+        else:
+            result["status"] = "rejected"
+            result["reason"] = e.reason
+    except Exception as e:
+        result["status"] = "failed"
+        result["reason"] = str(e)
+    result["submit_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+def file_run_id(path):
+    """Hash of the file contents, so rerunning a file resumes it while a rewritten file starts a new run"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+def submit_file(path, results_path, concurrency=8, run_id=None):
+    """Submits every order of the file not yet recorded in results_path, returns the count of rows processed"""
+    run_id = run_id or file_run_id(path)
+    done = recorded_rows(results_path, run_id)
+    write_header = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+    processed = 0
+    with open(results_path, "a", newline="", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        writer = csv.DictWriter(f, fieldnames=result_fields)
+        if write_header:
+            writer.writeheader()
+
+        def record(finished):
+            for future in finished:
+                writer.writerow(future.result())
+            f.flush() #every recorded row survives a crash
+
+        #at most 2 * concurrency rows are held in memory, reading pauses until some complete
+        in_flight = set()
+        for row_number, row in enumerate(read_rows(path)):
+            if row_number in done:
+                continue
+            if len(in_flight) >= 2 * concurrency:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                record(finished)
+            in_flight.add(pool.submit(process_row, row_number, row, run_id))
+            processed += 1
+        record(wait(in_flight).done)
+    return processed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Submit the orders of a csv or parquet file")
+    parser.add_argument("path", help="csv or parquet file of orders")
+    parser.add_argument("--results", help="results csv, defaults to <path>.results.csv")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests")
+    parser.add_argument("--requests-per-minute", type=int, default=200, help="API rate limit of each account")
+    parser.add_argument("--run-id", help="prefix of the client order ids, defaults to a hash of the file contents")
+    parser.add_argument("--log-file", help="write events as json lines to this file instead of text to stdout")
+    args = parser.parse_args()
+
+    if args.log_file:
+        log.configure(stream=open(args.log_file, "a", encoding="utf-8"), fmt="json")
+    for account in accounts:
+        account.rate_limiter.set_rate(args.requests_per_minute)
+    results_path = args.results or f"{args.path}.results.csv"
+    started = time.perf_counter()
+    processed = submit_file(args.path, results_path, args.concurrency, args.run_id)
+    print(f"Processed {processed} orders in {time.perf_counter() - started:.1f}s, results written to {results_path}")
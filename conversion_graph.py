@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Currency conversion graph of the crypto pairs, built from one batched quote snapshot
+
+Usd rates of every currency are precomputed when the snapshot is taken, so valuing
+any pair is a dictionary lookup. Routes of a cross pair (ETH/BTC) through USD or USDT
+are compared against the direct pair after spreads and tier fees
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+class ConversionGraph:
+    """
+    Fetch is called as fetch(symbols) and should return the latest crypto quotes by symbol,
+    the snapshot is retaken when it is older than max_age seconds
+    """
+    def __init__(self, fetch, pairs, max_age=2.0):
+        self.fetch = fetch
+        self.pairs = list(pairs)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.quotes = {}
+        self.rates = {}
+        self.fetched_at = None
+
+    def refresh(self):
+        snapshot = self.fetch(self.pairs)
+        quotes = {pair: (float(quote['bp']), float(quote['ap'])) for pair, quote in snapshot.items() if quote['bp'] and quote['ap']}
+        by_quote = defaultdict(list)
+        by_base = defaultdict(list)
+        for pair in quotes:
+            base, quote = pair.split('/')
+            by_quote[quote].append((base, pair))
+            by_base[base].append((quote, pair))
+
+        #(bid, ask) usd rate per currency, breadth first from USD so direct usd pairs are preferred
+        rates = {"USD": (1.0, 1.0)}
+        frontier = ["USD"]
+        while frontier:
+            next_frontier = []
+            for known in frontier:
+                known_bid, known_ask = rates[known]
+                for base, pair in by_quote[known]:
+                    if base not in rates:
+                        bid, ask = quotes[pair]
+                        rates[base] = (bid * known_bid, ask * known_ask)
+                        next_frontier.append(base)
+                for quote, pair in by_base[known]: #inverted pair, the known currency is the base
+                    if quote not in rates:
+                        bid, ask = quotes[pair]
+                        rates[quote] = (known_bid / ask, known_ask / bid)
+                        next_frontier.append(quote)
+            frontier = next_frontier
+
+        with self.lock:
+            self.quotes = quotes
+            self.rates = rates
+            self.fetched_at = time.monotonic()
+
+    def _fresh(self):
+        if self.fetched_at is None or time.monotonic() - self.fetched_at >= self.max_age:
+            self.refresh()
+
+    def usd_rate(self, currency, orderside, refresh=True):
+        """
+        Usd value of one unit of currency, at the ask for buys and at the bid for sells
+        Refresh=False values it from the current snapshot whatever its age, for callers keeping it fresh in the background
+        """
+        if refresh or self.fetched_at is None:
+            self._fresh()
+        rate = self.rates.get(currency)
+        if rate is None:
+            raise Exception(f"No conversion from {currency} to USD")
+        return rate[1] if orderside == 'buy' else rate[0]
+
+    def quote(self, pair):
+        """Returns (bid, ask) of pair"""
+        self._fresh()
+        return self.quotes[pair]
+
+    def routes(self, pair, orderside, qty, fee, via=("USD", "USDT")):
+        """
+        Costs of trading qty of the base currency of pair directly or through each currency of via
+        For buys the amount is the quote currency spent, for sells the quote currency received,
+        each leg pays its spread and fee. Legs are (pair, side, {"qty" or "notional": amount}) in order
+        of submission. Cost_usd is the loss against the mid price of the pair, cheapest route first
+        """
+        self._fresh()
+        base, quote = pair.split('/')
+        bid, ask = self.quotes[pair]
+        mid_amount = qty * (bid + ask) / 2
+        if orderside == 'buy':
+            candidates = [{"legs": [(pair, 'buy', {"qty": qty})], "amount": qty * ask * (1 + fee)}]
+        else:
+            candidates = [{"legs": [(pair, 'sell', {"qty": qty})], "amount": qty * bid * (1 - fee)}]
+
+        for intermediate in via:
+            base_leg = f"{base}/{intermediate}"
+            quote_leg = f"{quote}/{intermediate}"
+            if intermediate in (base, quote) or base_leg not in self.quotes or quote_leg not in self.quotes:
+                continue
+            base_bid, base_ask = self.quotes[base_leg]
+            quote_bid, quote_ask = self.quotes[quote_leg]
+            if orderside == 'buy':
+                #sell the quote currency for the intermediate, then buy the base currency with it
+                intermediate_needed = qty * base_ask * (1 + fee)
+                amount = intermediate_needed / (quote_bid * (1 - fee))
+                legs = [(quote_leg, 'sell', {"qty": amount}), (base_leg, 'buy', {"qty": qty})]
+            else:
+                #sell the base currency for the intermediate, then buy the quote currency with it
+                intermediate_received = qty * base_bid * (1 - fee)
+                amount = intermediate_received * (1 - fee) / quote_ask
+                legs = [(base_leg, 'sell', {"qty": qty}), (quote_leg, 'buy', {"notional": intermediate_received})]
+            candidates.append({"legs": legs, "amount": amount})
+
+        quote_usd = self.usd_rate(quote, orderside)
+        for candidate in candidates:
+            loss = candidate["amount"] - mid_amount if orderside == 'buy' else mid_amount - candidate["amount"]
+            candidate["cost_usd"] = loss * quote_usd
+        return sorted(candidates, key=lambda candidate: candidate["cost_usd"])
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking structured event log
+
+Callers only build a small dict and enqueue it, a background thread formats the
+events as text or json lines and writes them, so the order path never blocks on
+stdout. Events carry the correlation id of the order being processed, if any
+
+Usage: log.warning("order_rejected", ticker=ticker, reason=reason)
+Configure with log.configure(stream=open("events.jsonl", "a"), fmt="json", level="info")
+"""
+
+import atexit
+import contextvars
+import functools
+import json
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+levels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+@contextmanager
+def correlation(order_id=None):
+    """Tags every event logged inside the block with order_id, or a new id if none is given"""
+    token = correlation_id.set(order_id or uuid.uuid4().hex[:16])
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+def correlated(function):
+    """Runs function under its client_order_id (or a new id), unless it is called inside an existing correlation"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if correlation_id.get() is not None:
+            return function(*args, **kwargs)
+        with correlation(kwargs.get('client_order_id')):
+            return function(*args, **kwargs)
+    return wrapper
+
+def format_text(event):
+    fields = " ".join(f"{key}={value}" for key, value in event.items() if key not in ("ts", "level", "event", "correlation_id"))
+    correlation_tag = f" [{event['correlation_id']}]" if event.get('correlation_id') else ""
+    timestamp = datetime.fromtimestamp(event['ts'], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    return f"{timestamp} {event['level'].upper()} {event['event']}{correlation_tag} {fields}".rstrip()
+
+def format_json(event):
+    return json.dumps(event, default=str)
+
+class EventLogger:
+    def __init__(self, stream=None, fmt="text", level="info", queue_size=100000):
+        self.stream = stream
+        self.formatter = format_json if fmt == "json" else format_text
+        self.level = levels[level]
+        self.queue_size = queue_size
+        self.pending = queue.SimpleQueue() #put never blocks the caller, the writer sleeps in get until an event arrives
+        self.dropped = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def configure(self, stream=None, fmt=None, level=None):
+        if stream is not None:
+            self.flush()
+            self.stream = stream
+        if fmt is not None:
+            self.formatter = format_json if fmt == "json" else format_text
+        if level is not None:
+            self.level = levels[level]
+
+    def log(self, level, event, **fields):
+        if levels[level] < self.level:
+            return
+        record = {"ts": time.time(), "level": level, "event": event}
+        order_id = correlation_id.get()
+        if order_id is not None:
+            record["correlation_id"] = order_id
+        record.update(fields)
+        if self.writer is None:
+            self._start()
+        if self.pending.qsize() >= self.queue_size: #never block the caller, count what could not be logged
+            self.dropped += 1
+            return
+        self.pending.put(record)
+
+    def debug(self, event, **fields):
+        self.log("debug", event, **fields)
+
+    def info(self, event, **fields):
+        self.log("info", event, **fields)
+
+    def warning(self, event, **fields):
+        self.log("warning", event, **fields)
+
+    def error(self, event, **fields):
+        self.log("error", event, **fields)
+
+    def flush(self, timeout=5.0):
+        """Waits until every event queued before the call is written"""
+        if self.writer is None:
+            return
+        written = threading.Event() #the writer sets it once it reaches it, after every earlier event
+        self.pending.put(written)
+        written.wait(timeout)
+
+    def _start(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write, daemon=True)
+                self.writer.start()
+
+    def _write(self):
+        while True:
+            record = self.pending.get()
+            stream = self.stream or sys.stdout
+            flushed = []
+            try:
+                while True:
+                    if isinstance(record, threading.Event):
+                        flushed.append(record)
+                    else:
+                        stream.write(self.formatter(record) + "\n")
+                    try:
+                        record = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                stream.flush() #flush once per burst rather than per event
+            except Exception:
+                self.dropped += 1
+            finally:
+                for written in flushed:
+                    written.set()
+
+log = EventLogger()
+atexit.register(log.flush)
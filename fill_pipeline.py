@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Background fill-to-cost pipeline
+
+Consumes order status changes from the trade_updates stream (or from polling the
+open orders when the stream is unavailable), computes slippage and tier fees for
+every fill, including partial fills, and writes one cost record per fill to a sink
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from config_alpaca import API_KEY, SECRET_KEY
+from event_log import log
+from backfill import fetch_window
+from market_clock import parse_timestamp
+from HTTP_request_version import (trading_url, headers_get_request, safe_get_request, return_latest_price,
+                                  crypto_pairs, prices, tier_fee, monthly_crypto_volume, conversion_graph)
+
+try:
+    import websocket #optional, pip install websocket-client, otherwise open orders are polled
+except ImportError:
+    websocket = None
+
+stream_url = trading_url.replace("https://", "wss://") + "/stream"
+terminal_statuses = {"filled", "canceled", "expired", "rejected", "done_for_day", "replaced"}
+
+def event_timestamp(timestamp):
+    """Epoch seconds of an API timestamp, None when it is missing"""
+    return parse_timestamp(timestamp).timestamp() if timestamp else None
+
+def fill_time(order):
+    #polled orders carry the time of their last fill in filled_at, partial fills in updated_at
+    return event_timestamp(order.get('filled_at') or order.get('updated_at'))
+
+class JsonLinesSink:
+    """Appends every cost record as one json line, safe to share between workers"""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class QuoteCache:
+    """Latest bid/ask per pair, refreshed at most every max_age seconds"""
+    def __init__(self, max_age=1.0):
+        self.max_age = max_age
+        self.quotes = {}
+        self.lock = threading.Lock()
+
+    def get(self, ticker, orderside):
+        key = (ticker, orderside)
+        with self.lock:
+            cached = self.quotes.get(key)
+        if cached and time.monotonic() - cached[1] < self.max_age:
+            return cached[0]
+        price = float(return_latest_price(ticker, orderside))
+        with self.lock:
+            self.quotes[key] = (price, time.monotonic())
+        return price
+
+def fill_cost(order, fill_qty, fill_price, quotes):
+    """
+    Slippage and trading tier fee in usd of a single fill of order
+    Reference prices come from the snapshot open_new_trade stored at submission, orders submitted
+    elsewhere fall back to their limit price or the cached live bid/ask
+    """
+    symbol = order['symbol']
+    orderside = order['side']
+    snapshot = prices.get(order['submitted_at'], {})
+
+    market_price_at_fill = snapshot.get('bid/ask at fill')
+    if market_price_at_fill is None:
+        if order.get('limit_price'):
+            market_price_at_fill = float(order['limit_price'])
+        else:
+            market_price_at_fill = quotes.get(symbol, orderside)
+
+    #crypto pairs not quoted in USD are converted to usd through the conversion graph
+    usd_rate = 1.0
+    if symbol in crypto_pairs and not symbol.endswith('/USD'):
+        usd_rate = snapshot.get('BTC/USD at submission') or conversion_graph.usd_rate(symbol.split('/')[1], orderside, refresh=False)
+
+    slippage_cost = abs(market_price_at_fill - fill_price) * fill_qty * usd_rate
+    if symbol in crypto_pairs:
+        #the fee tier and the rates are refreshed in the background, a fill is never held up by their downloads
+        trading_fees = fill_qty * fill_price * usd_rate * tier_fee(order['order_type'], monthly_crypto_volume(wait=False))
+    else: #stock trading has no trading fees
+        trading_fees = 0.0
+    return slippage_cost, trading_fees
+
+class FillCostPipeline:
+    """
+    Orders are sharded by id over the workers, so every order is processed in sequence by one worker
+    and the per-order fill state needs no locking. Queues are bounded (producers block when workers fall
+    behind) and only orders with open fills are tracked, evicting the oldest past max_tracked_orders
+    """
+    def __init__(self, sink, workers=4, queue_size=10000, max_tracked_orders=50000, poll_interval=2.0, use_stream=True):
+        self.sink = sink
+        self.poll_interval = poll_interval
+        self.use_stream = use_stream and websocket is not None
+        self.max_tracked_per_worker = max(1, max_tracked_orders // workers)
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.fill_state = [OrderedDict() for _ in range(workers)]
+        self.quotes = QuoteCache()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.ws = None
+
+    def start(self):
+        monthly_crypto_volume() #warm the fee tier cache so the first fill is not delayed by the order history download
+        conversion_graph.refresh()
+        for shard in range(len(self.queues)):
+            self.threads.append(threading.Thread(target=self._worker, args=(shard,), daemon=True))
+        self.threads.append(threading.Thread(target=self._run_source, daemon=True))
+        self.threads.append(threading.Thread(target=self._refresh_rates, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.ws is not None:
+            self.ws.close()
+        for shard, q in enumerate(self.queues):
+            #a saturated worker would never make room for the stop marker, its pending updates are dropped instead
+            dropped = 0
+            while True:
+                try:
+                    q.put_nowait(None)
+                    break
+                except queue.Full:
+                    try:
+                        while True:
+                            q.get_nowait()
+                            dropped += 1
+                    except queue.Empty:
+                        pass
+            if dropped:
+                log.warning("fill_updates_dropped", shard=shard, dropped=dropped, reason="pipeline stopped with a full queue")
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def _refresh_rates(self):
+        """Retakes the conversion graph snapshot every max_age seconds, so workers value fills from memory"""
+        while not self.stopped.wait(conversion_graph.max_age):
+            try:
+                conversion_graph.refresh()
+            except Exception as e:
+                log.warning("rates_refresh_failed", error=str(e))
+
+    def submit(self, order, event_time=None):
+        """
+        Queue an order status update, blocks when the owning worker is saturated
+        Event_time is the epoch time of the fill the update reports, latency_ms of the cost record is measured from it
+        """
+        shard = hash(order['id']) % len(self.queues)
+        self.queues[shard].put((order, event_time or time.time()))
+
+    def _worker(self, shard):
+        q = self.queues[shard]
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                self._process(shard, *item)
+            except Exception as e:
+                log.error("fill_cost_failed", order_id=item[0].get('id'), error=str(e))
+
+    def _process(self, shard, order, event_time):
+        state = self.fill_state[shard]
+        order_id = order['id']
+        filled_qty = float(order['filled_qty'] or 0)
+        avg_price = float(order['filled_avg_price'] or 0)
+        previous_qty, previous_avg_price = state.get(order_id, (0.0, 0.0))
+
+        #the stream and the orders endpoint both report cumulative fills, the new fill is the difference
+        fill_qty = filled_qty - previous_qty
+        if fill_qty > 0:
+            fill_price = (filled_qty * avg_price - previous_qty * previous_avg_price) / fill_qty
+            slippage_cost, trading_fees = fill_cost(order, fill_qty, fill_price, self.quotes)
+            self.sink({
+                "order_id": order_id,
+                "symbol": order['symbol'],
+                "side": order['side'],
+                "status": order['status'],
+                "fill_qty": fill_qty,
+                "fill_price": fill_price,
+                "filled_qty": filled_qty,
+                "slippage_cost": slippage_cost,
+                "trading_fees": trading_fees,
+                "total_cost": slippage_cost + trading_fees,
+                "event_time": datetime.fromtimestamp(event_time, timezone.utc).isoformat(),
+                "latency_ms": (time.time() - event_time) * 1000
+            })
+
+        if order['status'] in terminal_statuses:
+            state.pop(order_id, None)
+        elif fill_qty > 0:
+            state[order_id] = (filled_qty, avg_price)
+            state.move_to_end(order_id)
+            if len(state) > self.max_tracked_per_worker:
+                state.popitem(last=False)
+
+    def _run_source(self):
+        if self.use_stream:
+            try:
+                self._run_stream()
+            except Exception as e:
+                log.warning("stream_unavailable", error=str(e), fallback="polling")
+        if not self.stopped.is_set():
+            self._run_polling()
+
+    def _run_stream(self):
+        self.ws = websocket.create_connection(stream_url, timeout=10)
+        self.ws.send(json.dumps({"action": "auth", "key": API_KEY, "secret": SECRET_KEY}))
+        self.ws.send(json.dumps({"action": "listen", "data": {"streams": ["trade_updates"]}}))
+        self.ws.settimeout(None)
+        while not self.stopped.is_set():
+            message = self.ws.recv()
+            if not message:
+                raise Exception("stream closed")
+            message = json.loads(message)
+            if message.get('stream') == 'authorization' and message['data']['status'] != 'authorized':
+                raise Exception("stream authorization failed")
+            if message.get('stream') == 'trade_updates':
+                self.submit(message['data']['order'], event_timestamp(message['data'].get('timestamp')))
+
+    def _list_orders(self, status, after=None):
+        #pages overlap by the orders submitted in the instant of each page's last order, repeats are dropped by id
+        listed = {}
+        for order in fetch_window(lambda params: safe_get_request(f"{trading_url}/v2/orders", headers=headers_get_request, params=params),
+                                  after, None, status=status):
+            listed[order['id']] = order
+        return list(listed.values())
+
+    def _run_polling(self):
+        #per poll: the pages of open orders, the orders closed since the last poll that were never seen open,
+        #and one request per watched order that left the open list
+        watched = set()
+        closed_seen = OrderedDict()
+        last_poll = datetime.now(timezone.utc)
+        while not self.stopped.is_set():
+            poll_started = datetime.now(timezone.utc)
+            open_ids = set()
+            for order in self._list_orders("open"):
+                open_ids.add(order['id'])
+                if float(order['filled_qty'] or 0) > 0:
+                    self.submit(order, fill_time(order))
+            for order_id in watched - open_ids:
+                order = safe_get_request(f"{trading_url}/v2/orders/{order_id}", headers=headers_get_request)
+                self.submit(order, fill_time(order))
+                closed_seen[order_id] = True
+            for order in self._list_orders("closed", after=last_poll - timedelta(seconds=self.poll_interval)):
+                if order['id'] not in closed_seen and order['id'] not in watched:
+                    self.submit(order, fill_time(order))
+                    closed_seen[order['id']] = True
+            while len(closed_seen) > self.max_tracked_per_worker:
+                closed_seen.popitem(last=False)
+            watched = open_ids
+            last_poll = poll_started
+            self.stopped.wait(self.poll_interval)
+
+if __name__ == "__main__":
+
+    sink = JsonLinesSink("fill_costs.jsonl")
+    pipeline = FillCostPipeline(sink)
+    pipeline.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pipeline.stop()
+        sink.close()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of the US equity market clock and calendar
+
+The clock and calendar are fetched once and then refreshed only when a session
+boundary (pre-market open, open, close, post-market close) is crossed, so order
+construction can look up the current session without any per-order request
+"""
+
+import re
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+    eastern = ZoneInfo("America/New_York")
+except ImportError: #python < 3.9, the offset of the clock response is used instead
+    eastern = None
+
+def parse_timestamp(timestamp):
+    #the clock returns nanoseconds, datetime only parses up to microseconds
+    timestamp = re.sub(r"(\.\d{6})\d+", r"\1", timestamp.replace("Z", "+00:00"))
+    return datetime.fromisoformat(timestamp)
+
+class MarketClock:
+    """
+    Fetch is called as fetch(path, params) with trading API paths relative to /v2 (/clock, /calendar)
+    and should return the decoded json response
+    """
+    def __init__(self, fetch, calendar_days=14):
+        self.fetch = fetch
+        self.calendar_days = calendar_days
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.boundaries = []
+        self.next_refresh = None
+
+    def refresh(self, now=None, force=True):
+        """Fetches the clock and calendar, force=False skips it when another caller already refreshed past now"""
+        with self.lock:
+            now = now or datetime.now(timezone.utc)
+            if not force and self.next_refresh is not None and now < self.next_refresh:
+                return
+            clock = self.fetch("/clock", None)
+            market_tz = eastern or parse_timestamp(clock['timestamp']).tzinfo
+            start = now.astimezone(market_tz).date()
+            calendar = self.fetch("/calendar", {"start": start.isoformat(),
+                                                "end": (start + timedelta(days=self.calendar_days)).isoformat()})
+
+            def market_time(date, hour_minute):
+                hour_minute = hour_minute.replace(":", "")
+                return datetime.strptime(date + hour_minute, "%Y-%m-%d%H%M").replace(tzinfo=market_tz).astimezone(timezone.utc)
+
+            #each session is (pre-market open, open, close, post-market close)
+            sessions = []
+            for day in calendar:
+                sessions.append((market_time(day['date'], day.get('session_open', day['open'])),
+                                 market_time(day['date'], day['open']),
+                                 market_time(day['date'], day['close']),
+                                 market_time(day['date'], day.get('session_close', day['close']))))
+            self.sessions = sessions
+            self.boundaries = sorted(boundary for session in sessions for boundary in session)
+            #refresh again at the next boundary, or before the calendar runs out
+            upcoming = bisect_right(self.boundaries, now)
+            if upcoming < len(self.boundaries):
+                self.next_refresh = self.boundaries[upcoming]
+            else:
+                self.next_refresh = now + timedelta(hours=12)
+
+    def session(self, now=None):
+        """Returns 'pre', 'regular', 'post' or 'closed' for now"""
+        now = now or datetime.now(timezone.utc)
+        if self.next_refresh is None or now >= self.next_refresh:
+            #callers crossing the boundary together wait on the lock, only the first one fetches
+            self.refresh(now, force=False)
+        for premarket_open, market_open, market_close, postmarket_close in self.sessions:
+            if now < premarket_open:
+                break
+            if now < market_open:
+                return 'pre'
+            if now < market_close:
+                return 'regular'
+            if now < postmarket_close:
+                return 'post'
+        return 'closed'
+
+    def next_open(self, now=None, extended_hours=False):
+        """Start of the next regular session, or of the next pre-market session with extended_hours"""
+        now = now or datetime.now(timezone.utc)
+        for premarket_open, market_open, market_close, postmarket_close in self.sessions:
+            session_open = premarket_open if extended_hours else market_open
+            if session_open > now:
+                return session_open
+        return None
+
+def session_rejection(market_clock, ordertype, extended_hours=False, now=None, tif="day"):
+    """
+    Reason a us equity order cannot trade in the current session, or None if it can
+    Tif is the time in force build_order gives the order (order_core.time_in_force). Good until cancelled orders
+    rest on the book and are queued by the server until the next open, so they are accepted in every session.
+    Day orders outside the regular session only trade as limit orders flagged extended_hours, until the post-market close
+    """
+    session = market_clock.session(now)
+    if session == 'regular' or tif == 'gtc':
+        return None
+    if session in ('pre', 'post'):
+        if ordertype == 'limit' and extended_hours:
+            return None
+        return f"US equity market is in its {session}-market session, only limit orders with extended_hours or whole share orders good until cancelled can be placed"
+    next_open = market_clock.next_open(now, extended_hours)
+    return f"US equity market is closed, day orders cannot be placed until the next session opens at {next_open.isoformat() if next_open else 'an unknown time'}"
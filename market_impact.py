@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-trade market impact estimates for crypto pairs from cached L2 order book snapshots
+
+Each side of a book is held as numpy arrays of level prices with cumulative sizes and
+notionals, so walking the book for an order is a binary search rather than a loop
+"""
+
+import threading
+import time
+import numpy as np
+
+class BookSide:
+    def __init__(self, levels):
+        self.prices = np.array([level['p'] for level in levels], dtype=float)
+        sizes = np.array([level['s'] for level in levels], dtype=float)
+        self.cum_sizes = np.cumsum(sizes)
+        self.cum_notionals = np.cumsum(sizes * self.prices)
+
+    def walk(self, qty=None, notional=None):
+        """Returns (average fill price, worst level price, filled qty) of taking qty or notional from this side"""
+        if len(self.prices) == 0:
+            return None, None, 0.0
+        cumulative = self.cum_sizes if qty is not None else self.cum_notionals
+        amount = qty if qty is not None else notional
+        level = int(np.searchsorted(cumulative, amount))
+        if level >= len(self.prices): #not enough depth, the whole side is taken
+            return self.cum_notionals[-1] / self.cum_sizes[-1], self.prices[-1], self.cum_sizes[-1]
+        taken_sizes = self.cum_sizes[level - 1] if level else 0.0
+        taken_notionals = self.cum_notionals[level - 1] if level else 0.0
+        if qty is not None:
+            filled = qty
+            fill_notional = taken_notionals + (qty - taken_sizes) * self.prices[level]
+        else:
+            filled = taken_sizes + (notional - taken_notionals) / self.prices[level]
+            fill_notional = notional
+        return fill_notional / filled, self.prices[level], filled
+
+    def max_qty(self, max_impact):
+        """Largest qty whose average fill price stays within max_impact of the best price"""
+        if len(self.prices) == 0:
+            return 0.0
+        best = self.prices[0]
+        target = best * (1 + max_impact) if self.prices[-1] >= best else best * (1 - max_impact)
+        impacts = np.abs(self.cum_notionals / self.cum_sizes / best - 1)
+        level = int(np.searchsorted(impacts, max_impact, side='right')) #average impact only grows with depth
+        if level >= len(self.prices):
+            return self.cum_sizes[-1]
+        taken_sizes = self.cum_sizes[level - 1] if level else 0.0
+        taken_notionals = self.cum_notionals[level - 1] if level else 0.0
+        #solve (taken_notionals + x * price) / (taken_sizes + x) = target for the part x of the next level
+        return taken_sizes + (target * taken_sizes - taken_notionals) / (self.prices[level] - target)
+
+class OrderBookCache:
+    """
+    Fetch is called as fetch(symbols) and should return the orderbooks of the crypto latest orderbooks
+    endpoint by symbol. Books older than max_age seconds are refreshed together in one request
+    """
+    def __init__(self, fetch, max_age=2.0):
+        self.fetch = fetch
+        self.max_age = max_age
+        self.books = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, symbols):
+        orderbooks = self.fetch(sorted(set(symbols)))
+        fetched_at = time.monotonic()
+        with self.lock:
+            for symbol, book in orderbooks.items():
+                self.books[symbol] = (BookSide(book['a']), BookSide(book['b']), fetched_at)
+
+    def book(self, symbol):
+        """Returns (asks, bids) of symbol, raises an exception when the orderbooks response leaves out symbol"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.books.get(symbol)
+            stale = [cached_symbol for cached_symbol, (_, _, fetched_at) in self.books.items() if now - fetched_at >= self.max_age]
+        if cached is None or now - cached[2] >= self.max_age:
+            self.refresh(stale + [symbol])
+            with self.lock:
+                cached = self.books.get(symbol)
+            #an expired snapshot the refresh did not replace is as unusable as no snapshot
+            if cached is None or now - cached[2] >= self.max_age:
+                raise Exception(f"No order book returned for {symbol}")
+        return cached[0], cached[1]
+
+    def estimate_impact(self, symbol, orderside, qty=None, notional=None):
+        """
+        Expected execution of a market order of qty (or notional) on symbol
+        Impact is the relative distance of the average fill price from the best price
+        """
+        asks, bids = self.book(symbol)
+        side = asks if orderside == 'buy' else bids
+        avg_price, worst_price, filled = side.walk(qty, notional)
+        if avg_price is None:
+            return {"best_price": None, "avg_price": None, "worst_price": None, "impact": float('inf'),
+                    "filled_qty": 0.0, "insufficient_depth": True}
+        best_price = side.prices[0]
+        #compared against the depth of the side, not the filled qty, which a notional order only gets back after a float round trip
+        insufficient_depth = qty > side.cum_sizes[-1] if qty is not None else notional > side.cum_notionals[-1]
+        return {
+            "best_price": float(best_price),
+            "avg_price": float(avg_price),
+            "worst_price": float(worst_price),
+            "impact": float(abs(avg_price / best_price - 1)),
+            "filled_qty": float(filled),
+            "insufficient_depth": bool(insufficient_depth)
+        }
+
+    def max_qty(self, symbol, orderside, max_impact):
+        asks, bids = self.book(symbol)
+        return float((asks if orderside == 'buy' else bids).max_qty(max_impact))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Order construction shared by every transport
+
+Which combinations of asset class, order type and order class can be traded, and with
+which amounts and options, is described once in order_table. check_order validates an
+order against it without any request, build_order turns it into the json payload of
+the orders endpoint and refuses any order the table does not support
+"""
+
+#(asset class, order type, order class): what the combination supports
+#notional amounts only work for market orders, take profit/stop loss legs need whole share qty,
+#extended hours only applies to simple us equity limit orders, crypto has no take profit/stop loss
+order_table = {
+    ("us_equity", "market", "simple"): {"notional": True, "fractional": True, "extended_hours": False},
+    ("us_equity", "market", "oto"): {"notional": False, "fractional": False, "extended_hours": False},
+    ("us_equity", "market", "bracket"): {"notional": False, "fractional": False, "extended_hours": False},
+    ("us_equity", "limit", "simple"): {"notional": False, "fractional": True, "extended_hours": True},
+    ("us_equity", "limit", "oto"): {"notional": False, "fractional": False, "extended_hours": False},
+    ("us_equity", "limit", "bracket"): {"notional": False, "fractional": False, "extended_hours": False},
+    ("crypto", "market", "simple"): {"notional": True, "fractional": True, "extended_hours": False},
+    ("crypto", "limit", "simple"): {"notional": False, "fractional": True, "extended_hours": False},
+}
+
+def order_class_of(takeprofit=None, stoploss=None):
+    if takeprofit and stoploss:
+        return "bracket"
+    if takeprofit or stoploss:
+        return "oto"
+    return "simple"
+
+def time_in_force(asset_class, notional=None, qty=None, extended_hours=False):
+    #crypto orders are good until cancelled, fractional and extended hours stock orders must be day orders,
+    #whole share stock orders default to good until cancelled
+    if asset_class == "crypto":
+        return "gtc"
+    if notional or isinstance(qty, float) or extended_hours:
+        return "day"
+    return "gtc"
+
+def check_order(asset_class, ordertype, orderside, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, extended_hours=False):
+    """Returns the reason the order cannot be built, or None if it can"""
+    if notional is None and qty is None:
+        return "Either notional or quantity must be passed"
+    if orderside not in ('buy', 'sell'):
+        return f"Invalid input {orderside}"
+    if ordertype not in ('market', 'limit'):
+        return f"Invalid input {ordertype}"
+    if notional and qty:
+        return "Both notional and qty cannot be passed"
+    if ordertype == 'limit' and limitprice is None:
+        return "Limit price must be included with limit order type"
+
+    spec = order_table.get((asset_class, ordertype, order_class_of(takeprofit, stoploss)))
+    if spec is None:
+        return "Crypto orders do not support take profit and stop loss"
+    if notional and not spec["notional"]:
+        if takeprofit or stoploss:
+            return "For non-simple orders with take profit/stop loss, non-fractional qty must be provided not notional"
+        return "Notional is only supported for market orders, qty must be provided for limit orders"
+    if isinstance(qty, float) and not spec["fractional"]:
+        return "For non-simple orders with take profit/stop loss, qty must be non-fractional"
+    if extended_hours and not spec["extended_hours"]:
+        return "Extended hours orders must be simple us equity limit orders"
+
+def build_order(ticker, asset_class, ordertype, orderside, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None, extended_hours=False, client_order_id=None):
+    """Payload of the orders endpoint for an order that passed check_order"""
+    order_class = order_class_of(takeprofit, stoploss)
+    spec = order_table.get((asset_class, ordertype, order_class))
+    if (spec is None or (notional and not spec["notional"]) or (isinstance(qty, float) and not spec["fractional"])
+            or (extended_hours and not spec["extended_hours"])):
+        raise Exception(f"Unsupported {asset_class} {ordertype} {order_class} order, orders must pass check_order before they are built")
+    #keys in the order of the original payloads
+    if notional:
+        order_data = {"symbol": ticker, "notional": notional, "side": orderside, "type": ordertype}
+    else:
+        order_data = {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype}
+    if ordertype == 'limit':
+        order_data["limit_price"] = limitprice
+    order_data["time_in_force"] = time_in_force(asset_class, notional, qty, extended_hours)
+    order_data["order_class"] = order_class
+    if extended_hours:
+        order_data["extended_hours"] = True
+    if takeprofit:
+        order_data["take_profit"] = {"limit_price": takeprofit}
+    if stoploss:
+        order_data["stop_loss"] = {"stop_price": stoploss}
+    if client_order_id is not None:
+        order_data["client_order_id"] = client_order_id
+    return order_data
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the order path
+
+While enabled, every top-level call of a @profiled function (open_new_trade, fee_simulator)
+records the ordered list of http requests it triggered, with bytes sent and received, time
+spent in the request and time waiting on the rate limit, the call stack that issued each
+request, and the cProfile cpu hotspots of the call. Results are written as a summary table
+or as collapsed stacks of request time, which flamegraph.pl and speedscope read directly.
+A request budget turns "max N requests per order" into an error
+
+Usage: profiler.enable(max_requests=4), then profiler.summary() or profiler.write_collapsed("requests.folded")
+"""
+
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from event_log import log, correlation_id
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+class RequestBudgetExceeded(Exception):
+    """Raised when a profiled call made more requests than its budget, carries the call's profile"""
+    def __init__(self, profile, max_requests):
+        self.profile = profile
+        self.max_requests = max_requests
+        super().__init__(f"{profile.name} made {len(profile.requests)} requests, budget is {max_requests}")
+
+def call_stack(skip=1):
+    """Functions of this repo on the current stack, outermost first"""
+    frames = []
+    frame = sys._getframe(skip)
+    while frame is not None:
+        code = frame.f_code
+        #decorator wrappers of event_log and profiling would only add noise
+        if code.co_filename.startswith(repo_dir) and os.path.basename(code.co_filename) not in ("profiling.py", "event_log.py"):
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            frames.append(f"{module}.{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    return frames[::-1]
+
+class CallProfile:
+    def __init__(self, name):
+        self.name = name
+        self.correlation_id = correlation_id.get()
+        self.requests = []
+        self.stats = None
+        self.seconds = 0.0
+        self.lock = threading.Lock() #requests may be recorded from worker threads
+
+    def record_request(self, method, url, status, sent, received, seconds, waited=0.0, stack=None):
+        with self.lock:
+            self.requests.append({"method": method, "url": url, "status": status, "sent": sent, "received": received,
+                                  "ms": seconds * 1000, "wait_ms": waited * 1000, "stack": stack if stack is not None else call_stack()})
+
+    def request_ms(self):
+        return sum(request["ms"] for request in self.requests)
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.cpu = True
+        self.max_requests = None
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def enable(self, cpu=True, max_requests=None):
+        """
+        Starts profiling top-level calls, cpu=False records requests only
+        Max_requests is the request budget of every call, or a dict of budgets by function name ({"open_new_trade": 4})
+        """
+        self.cpu = cpu
+        self.max_requests = max_requests
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.profiles = []
+
+    @contextmanager
+    def profile(self, name, max_requests=None):
+        """Profiles the block as one top-level call, raises RequestBudgetExceeded when it makes more than max_requests requests"""
+        call_profile = CallProfile(name)
+        token = current_profile.set(call_profile)
+        cpu_profile = cProfile.Profile() if self.cpu else None
+        if cpu_profile is not None:
+            try:
+                cpu_profile.enable()
+            except ValueError: #python 3.12+ allows one cProfile at a time, concurrent calls record requests only
+                cpu_profile = None
+        started = time.perf_counter()
+        try:
+            yield call_profile
+        finally:
+            call_profile.seconds = time.perf_counter() - started
+            if cpu_profile is not None:
+                cpu_profile.disable()
+                call_profile.stats = pstats.Stats(cpu_profile)
+            current_profile.reset(token)
+            with self.lock:
+                self.profiles.append(call_profile)
+        if max_requests is None:
+            max_requests = self.max_requests.get(name) if isinstance(self.max_requests, dict) else self.max_requests
+        if max_requests is not None and len(call_profile.requests) > max_requests:
+            log.error("request_budget_exceeded", call=name, requests=len(call_profile.requests), max_requests=max_requests)
+            raise RequestBudgetExceeded(call_profile, max_requests)
+
+    def summary(self, hotspots=15):
+        """Table of every profiled call and its requests, followed by the cpu hotspots of all calls"""
+        lines = [f"{'call':<28}{'correlation id':<20}{'requests':>9}{'sent B':>9}{'recv B':>10}{'request ms':>12}{'wait ms':>9}{'wall ms':>9}"]
+        for call_profile in self.profiles:
+            requests = call_profile.requests
+            lines.append(f"{call_profile.name:<28}{call_profile.correlation_id or '':<20}{len(requests):>9}"
+                         f"{sum(request['sent'] for request in requests):>9}{sum(request['received'] for request in requests):>10}"
+                         f"{call_profile.request_ms():>12.1f}{sum(request['wait_ms'] for request in requests):>9.1f}{call_profile.seconds * 1000:>9.1f}")
+            for i, request in enumerate(requests):
+                #the innermost callers outside the transport plumbing, innermost first
+                callers = [frame for frame in request['stack'] if not frame.startswith(("transports.", "accounts."))][-3:]
+                caller = " < ".join(reversed(callers))
+                lines.append(f"    {i + 1:>3} {request['method']:<5}{request['status']!s:<6}{request['ms']:>8.1f} ms {request['received']:>8} B  {request['url']}  <- {caller}")
+        stats = [call_profile.stats for call_profile in self.profiles if call_profile.stats is not None]
+        if stats:
+            output = io.StringIO()
+            merged = pstats.Stats(stream=output)
+            merged.add(*stats) #merged into a new Stats, the stats of each call stay as recorded
+            merged.sort_stats("tottime").print_stats(hotspots)
+            lines.append("")
+            lines.append(output.getvalue().strip())
+        return "\n".join(lines)
+
+    def collapsed_stacks(self):
+        """Request time in microseconds by call stack, 'outermost;...;innermost;request count' per line"""
+        stacks = Counter()
+        for call_profile in self.profiles:
+            for request in call_profile.requests:
+                endpoint = request['url'].split("?")[0].split("://")[-1]
+                frames = request['stack']
+                if not frames or not frames[0].endswith("." + call_profile.name): #requests made from worker threads
+                    frames = [call_profile.name] + frames
+                frames = frames + [f"{request['method']} {endpoint}"]
+                stacks[";".join(frame.replace(";", ",").replace(" ", "_") for frame in frames)] += max(1, round(request['ms'] * 1000))
+        return [f"{stack} {count}" for stack, count in stacks.items()]
+
+    def write_collapsed(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
+
+profiler = Profiler()
+
+def active_profile():
+    return current_profile.get()
+
+def profiled(function):
+    """Profiles each top-level call of function while the profiler is enabled, nested calls belong to the outer call"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled or current_profile.get() is not None:
+            return function(*args, **kwargs)
+        with profiler.profile(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Token bucket limiting the request rate of every thread sharing it to the API rate limit
+"""
+
+import threading
+import time
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=200):
+        self.lock = threading.Lock()
+        self.set_rate(requests_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def set_rate(self, requests_per_minute):
+        with self.lock:
+            self.rate = requests_per_minute / 60
+            self.capacity = requests_per_minute
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        """Stops every thread from sending for seconds, used when the server answers 429"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
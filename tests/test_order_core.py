@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Payloads of order_core against the if/elif trees open_new_trade used before the order table,
+for every combination of asset class, order type, order class, amount, extended hours and side
+
+Usage: python -m pytest tests
+"""
+
+import itertools
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from order_core import order_table, order_class_of, check_order, build_order
+
+def legacy_payload(ticker, asset_class, ordertype, orderside, notional=None, qty=None, limitprice=None, takeprofit=None, stoploss=None):
+    """
+    The json open_new_trade of HTTP_request_version.py posted before the order table, branch by branch
+    Only fix: the stop loss limit branch sent "time-in_force", it is spelled "time_in_force" here
+    """
+    if asset_class == 'us_equity':
+        #Fractional orders for us equities default to 'day' orders, non-fractional orders to 'good until close' orders
+        time_in_force = "day" if notional or isinstance(qty, float) else "gtc"
+    if ordertype == 'market':
+        if asset_class == 'us_equity':
+            if takeprofit and stoploss:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "time_in_force": time_in_force,
+                        "order_class": "bracket", "take_profit": {"limit_price": takeprofit}, "stop_loss": {"stop_price": stoploss}}
+            elif takeprofit:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "time_in_force": time_in_force,
+                        "order_class": "oto", "take_profit": {"limit_price": takeprofit}}
+            elif stoploss:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "time_in_force": time_in_force,
+                        "order_class": "oto", "stop_loss": {"stop_price": stoploss}}
+            elif notional:
+                return {"symbol": ticker, "notional": notional, "side": orderside, "type": ordertype, "time_in_force": time_in_force,
+                        "order_class": "simple"}
+            else:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "time_in_force": time_in_force,
+                        "order_class": "simple"}
+        else:
+            if notional:
+                return {"symbol": ticker, "notional": notional, "side": orderside, "type": ordertype, "time_in_force": "gtc",
+                        "order_class": "simple"}
+            else:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "time_in_force": "gtc",
+                        "order_class": "simple"}
+    else:
+        if asset_class == 'us_equity':
+            if takeprofit and stoploss:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "limit_price": limitprice,
+                        "time_in_force": time_in_force, "order_class": "bracket",
+                        "take_profit": {"limit_price": takeprofit}, "stop_loss": {"stop_price": stoploss}}
+            elif takeprofit:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "limit_price": limitprice,
+                        "time_in_force": time_in_force, "order_class": "oto", "take_profit": {"limit_price": takeprofit}}
+            elif stoploss:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "limit_price": limitprice,
+                        "time_in_force": time_in_force, "order_class": "oto", "stop_loss": {"stop_price": stoploss}}
+            else:
+                return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "limit_price": limitprice,
+                        "time_in_force": time_in_force, "order_class": "simple"}
+        else:
+            return {"symbol": ticker, "qty": qty, "side": orderside, "type": ordertype, "limit_price": limitprice,
+                    "time_in_force": "gtc", "order_class": "simple"}
+
+def expected_rejection(asset_class, ordertype, notional, qty, takeprofit, stoploss, extended_hours):
+    """Whether check_order must reject the order, from the rules of the old code and the intended changes"""
+    legs = takeprofit or stoploss
+    if asset_class == 'crypto' and legs:
+        return True
+    if legs and (notional or isinstance(qty, float)):
+        return True
+    #intended change: limit orders take a qty, the old code sent notional limit orders the API rejects
+    if ordertype == 'limit' and notional:
+        return True
+    #new option: extended hours only applies to simple us equity limit orders
+    if extended_hours and (asset_class != 'us_equity' or ordertype != 'limit' or legs):
+        return True
+    return False
+
+amounts = [{"notional": 500}, {"qty": 3}, {"qty": 0.5}]
+legs = [(None, None), (210, None), (None, 190), (210, 190)]
+cases = list(itertools.product(("us_equity", "crypto"), ("market", "limit"), ("buy", "sell"), amounts, legs, (False, True), (None, "cid-1")))
+
+def case_id(case):
+    asset_class, ordertype, orderside, amount, (takeprofit, stoploss), extended_hours, client_order_id = case
+    amount_name, amount_value = next(iter(amount.items()))
+    return f"{asset_class}-{ordertype}-{orderside}-{amount_name}{amount_value}-{order_class_of(takeprofit, stoploss)}" \
+           f"{'-tp' if takeprofit else ''}{'-sl' if stoploss else ''}{'-ext' if extended_hours else ''}{'-cid' if client_order_id else ''}"
+
+@pytest.mark.parametrize("case", cases, ids=case_id)
+def test_payload_matches_legacy(case):
+    asset_class, ordertype, orderside, amount, (takeprofit, stoploss), extended_hours, client_order_id = case
+    ticker = "AAPL" if asset_class == "us_equity" else "BTC/USD"
+    notional, qty = amount.get("notional"), amount.get("qty")
+    limitprice = 200 if ordertype == "limit" else None
+
+    reason = check_order(asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours)
+    if expected_rejection(asset_class, ordertype, notional, qty, takeprofit, stoploss, extended_hours):
+        assert reason is not None
+        with pytest.raises(Exception):
+            build_order(ticker, asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours, client_order_id)
+        return
+    assert reason is None
+
+    expected = legacy_payload(ticker, asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss)
+    if extended_hours: #extended hours orders must be day orders
+        expected["time_in_force"] = "day"
+        expected["extended_hours"] = True
+    if client_order_id is not None:
+        expected["client_order_id"] = client_order_id
+    payload = build_order(ticker, asset_class, ordertype, orderside, notional, qty, limitprice, takeprofit, stoploss, extended_hours, client_order_id)
+    #key order included, it is the order of the serialized body
+    assert list(payload.items()) == list(expected.items())
+
+def test_every_table_combination_is_built():
+    built = {(asset_class, ordertype, order_class_of(takeprofit, stoploss))
+             for asset_class, ordertype, orderside, amount, (takeprofit, stoploss), extended_hours, client_order_id in cases
+             if not expected_rejection(asset_class, ordertype, amount.get("notional"), amount.get("qty"), takeprofit, stoploss, extended_hours)}
+    assert built == set(order_table)
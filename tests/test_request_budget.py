@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Request budgets of open_new_trade, run against a stubbed requests session answering like the
+trading and market data APIs. A change adding requests to the order path fails these tests
+
+Usage: python -m pytest tests
+"""
+
+import json
+import os
+import sys
+import time
+import types
+from unittest import mock
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.modules.setdefault("config_alpaca", types.SimpleNamespace(API_KEY="test-key", SECRET_KEY="test-secret"))
+
+from profiling import profiler, RequestBudgetExceeded
+
+crypto_quotes = {"BTC/USD": {"bp": 60000.0, "ap": 60010.0}, "ETH/USD": {"bp": 3000.0, "ap": 3000.5},
+                 "ETH/BTC": {"bp": 0.0495, "ap": 0.0505}, "USDT/USD": {"bp": 0.9999, "ap": 1.0001}}
+
+def api_response(method, url, params, data):
+    path = url.split("://", 1)[1].split("/", 1)[1]
+    if path == "v2/account":
+        return {"buying_power": "1000000"}
+    if path == "v2/assets":
+        if params["asset_class"] == "crypto":
+            return [{"symbol": symbol, "tradable": True, "price_increment": "0.000001"} for symbol in crypto_quotes]
+        return [{"symbol": "AAPL", "tradable": True}]
+    if path == "v2/stocks/AAPL/quotes/latest":
+        return {"quote": {"bp": 199.9, "ap": 200.1}}
+    if path == "v1beta3/crypto/us/latest/quotes":
+        return {"quotes": {symbol: crypto_quotes[symbol] for symbol in params["symbols"].split(",")}}
+    if path == "v2/orders" and method == "POST":
+        order = json.loads(data)
+        order.update({"id": f"order-{order['symbol']}", "status": "accepted", "submitted_at": "2024-01-02T15:00:00Z"})
+        return order
+    if path == "v2/orders":
+        return []
+    raise AssertionError(f"unexpected request {method} {url}")
+
+def encode(payload):
+    return json.dumps(payload).encode()
+
+def stub_request(session, method, url, headers=None, params=None, json=None, data=None, timeout=None):
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = encode(api_response(method, url, params, data))
+    response.request = requests.Request(method, url, params=params, data=data).prepare()
+    response.url = response.request.url
+    return response
+
+@pytest.fixture(scope="module")
+def trading():
+    with mock.patch.object(requests.Session, "request", stub_request):
+        import HTTP_request_version
+        HTTP_request_version.market_clock.session = lambda now=None: 'regular'
+        yield HTTP_request_version
+
+@pytest.fixture
+def profiled_trading(trading):
+    #every order starts with expired quote snapshots and fee tier volume, as an order arriving after a quiet period
+    trading.default_account.info(refresh=True)
+    trading.default_account.cache.clear()
+    trading.default_account.cache["monthly_crypto_volume"] = (0.0, time.monotonic() - trading.volume_cache_ttl)
+    trading.conversion_graph.fetched_at = None
+    profiler.reset()
+    yield trading
+    profiler.disable()
+
+def test_equity_order_within_budget(profiled_trading):
+    profiler.enable(cpu=False, max_requests={"open_new_trade": 3})
+    assert profiled_trading.open_new_trade('AAPL', 'market', 'buy', qty=1) == "order-AAPL"
+    requests_made = [(request['method'], request['url'].split("?")[0]) for request in profiler.profiles[-1].requests]
+    assert requests_made == [("GET", "https://data.alpaca.markets/v2/stocks/AAPL/quotes/latest"),
+                             ("POST", "https://api.alpaca.markets/v2/orders"),
+                             ("GET", "https://data.alpaca.markets/v2/stocks/AAPL/quotes/latest")]
+
+def test_routed_cross_pair_order_within_budget(profiled_trading):
+    profiler.enable(cpu=False, max_requests={"open_new_trade": 5})
+    assert profiled_trading.open_new_trade('ETH/BTC', 'market', 'buy', qty=0.5, route='auto') == ["order-BTC/USD", "order-ETH/USD"]
+    endpoints = [request['url'].split("?")[0].split("/", 3)[3] for request in profiler.profiles[-1].requests]
+    #one quote snapshot, then each leg and its price snapshot, the expired fee tier volume is refreshed in the background
+    assert endpoints == ["v1beta3/crypto/us/latest/quotes",
+                         "v2/orders", "v1beta3/crypto/us/latest/quotes",
+                         "v2/orders", "v1beta3/crypto/us/latest/quotes"]
+
+def test_order_over_budget_raises(profiled_trading):
+    profiler.enable(cpu=False, max_requests={"open_new_trade": 4})
+    with pytest.raises(RequestBudgetExceeded) as exceeded:
+        profiled_trading.open_new_trade('ETH/BTC', 'market', 'buy', qty=0.5, route='auto')
+    assert len(exceeded.value.profile.requests) == 5
+    assert exceeded.value.max_requests == 4
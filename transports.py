@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Interchangeable transports submitting order payloads built by order_core
+
+Every transport has submit_order(order_data) returning the order json of the server:
+- RequestsTransport: pooled requests session, also used for every other request of HTTP_request_version.py
+- AlpacaPyTransport: the alpaca-py TradingClient used by Trade_execution.py
+- AsyncTransport: aiohttp on a background event loop, submit_orders sends a basket concurrently
+- MockTransport: answers locally, for dry runs and benchmarks
+
+Order bodies are serialized with orjson when it is installed, the stdlib json module otherwise
+"""
+
+import asyncio
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from event_log import log
+from profiling import active_profile, call_stack
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError: #only the requests transport needs it
+    requests = None
+
+try:
+    import aiohttp #optional, pip install aiohttp, only the async transport needs it
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson #optional, pip install orjson, several times faster order serialization
+except ImportError:
+    orjson = None
+
+json_headers = {"Content-Type": "application/json"}
+
+def dumps(data):
+    """Compact json body as bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+class RequestRejected(Exception):
+    """Raised when the server rejects a request, carries the status code and the server's reason"""
+    def __init__(self, status_code, reason):
+        self.status_code = status_code
+        self.reason = reason
+        super().__init__(f"{status_code}: {reason}")
+
+def rejection_reason(body, text):
+    return body.get('message', text) if isinstance(body, dict) else text
+
+class RequestsTransport:
+    name = "requests"
+
+    def __init__(self, base_url, api_key, secret_key, rate_limiter=None, pool_size=10, max_retries=5, time_delay=5):
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.time_delay = time_delay
+        #one session keeps connections alive across requests instead of a new tls handshake per request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "accept": "application/json",
+            "APCA-API-KEY-ID": f"{api_key}",
+            "APCA-API-SECRET-KEY": f"{secret_key}"
+        })
+
+    def request(self, method, url, headers=None, params=None, json=None, data=None):
+        """Url is either absolute or a path of base_url. Retries server and connection errors, raises RequestRejected on client errors"""
+        if url.startswith("/"):
+            url = self.base_url + url
+        profile = active_profile()
+        for attempt in range(self.max_retries):
+            try:
+                waiting = time.perf_counter()
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                started = time.perf_counter()
+                response = self.session.request(method, url, headers=headers, params=params, json=json, data=data, timeout=10)
+                if profile is not None:
+                    profile.record_request(method, response.request.url, response.status_code, len(response.request.body or b""),
+                                           len(response.content), time.perf_counter() - started, started - waiting)
+                if response.status_code == 429 and self.rate_limiter is not None:
+                    self.rate_limiter.backoff(float(response.headers.get("Retry-After", self.time_delay)))
+                elif 400 <= response.status_code < 500 and response.status_code != 429:
+                    try:
+                        reason = rejection_reason(response.json(), response.text)
+                    except ValueError:
+                        reason = response.text
+                    log.warning("request_rejected", url=url, status_code=response.status_code, reason=reason)
+                    raise RequestRejected(response.status_code, reason) #client errors are not retried, the same request fails again
+                response.raise_for_status()
+                return response.json()
+            except requests.exceptions.RequestException as e:
+                if profile is not None and not isinstance(e, requests.exceptions.HTTPError):
+                    profile.record_request(method, url, "error", 0, 0, time.perf_counter() - started, started - waiting)
+                log.warning("request_retry", url=url, error=str(e), attempt=attempt + 1, max_retries=self.max_retries)
+                time.sleep(self.time_delay)
+        log.error("request_failed", url=url, max_retries=self.max_retries)
+        raise Exception("Failed to return results")
+
+    def submit_order(self, order_data):
+        return self.request("POST", "/v2/orders", headers=json_headers, data=dumps(order_data))
+
+class AlpacaPyTransport:
+    name = "alpaca-py"
+
+    def __init__(self, trading_client):
+        self.trading_client = trading_client
+
+    def submit_order(self, order_data):
+        from alpaca.common.exceptions import APIError
+        try:
+            return self.trading_client.post("/orders", order_data)
+        except APIError as e:
+            log.warning("request_rejected", url="/orders", status_code=e.status_code, reason=str(e))
+            raise RequestRejected(e.status_code, str(e))
+
+class AsyncTransport:
+    name = "async"
+
+    def __init__(self, base_url, api_key, secret_key, rate_limiter=None, concurrency=10, max_retries=5, time_delay=5):
+        if aiohttp is None:
+            raise Exception("aiohttp is required for the async transport")
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.time_delay = time_delay
+        self.headers = {
+            "accept": "application/json",
+            "APCA-API-KEY-ID": f"{api_key}",
+            "APCA-API-SECRET-KEY": f"{secret_key}"
+        }
+        #the event loop runs in its own thread so synchronous callers can share one session
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.session = self._run(self._open_session(concurrency))
+
+    async def _open_session(self, concurrency):
+        return aiohttp.ClientSession(headers=self.headers, connector=aiohttp.TCPConnector(limit=concurrency))
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def submit_order_async(self, order_data, profile=None):
+        """Profile is the caller's active profile, the event loop thread does not share the caller's context"""
+        url = f"{self.base_url}/v2/orders"
+        body = dumps(order_data) #serialized once, not on every retry
+        stack = call_stack() if profile is not None else None
+        for attempt in range(self.max_retries):
+            waiting = time.perf_counter()
+            if self.rate_limiter is not None:
+                await self.loop.run_in_executor(None, self.rate_limiter.acquire)
+            started = time.perf_counter()
+            try:
+                async with self.session.post(url, data=body, headers=json_headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if profile is not None:
+                        profile.record_request("POST", url, response.status, len(body), response.content_length or 0,
+                                               time.perf_counter() - started, started - waiting, stack)
+                    if response.status == 429 and self.rate_limiter is not None:
+                        self.rate_limiter.backoff(float(response.headers.get("Retry-After", self.time_delay)))
+                    elif 400 <= response.status < 500 and response.status != 429:
+                        text = await response.text()
+                        try:
+                            reason = rejection_reason(await response.json(content_type=None), text)
+                        except ValueError:
+                            reason = text
+                        log.warning("request_rejected", url=url, status_code=response.status, reason=reason)
+                        raise RequestRejected(response.status, reason)
+                    response.raise_for_status()
+                    return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning("request_retry", url=url, error=str(e), attempt=attempt + 1, max_retries=self.max_retries)
+                await asyncio.sleep(self.time_delay)
+        log.error("request_failed", url=url, max_retries=self.max_retries)
+        raise Exception("Failed to return results")
+
+    def submit_order(self, order_data):
+        return self._run(self.submit_order_async(order_data, active_profile()))
+
+    def submit_orders(self, orders_data):
+        """Submits every payload concurrently, returns the responses in order (exceptions in place of failed orders)"""
+        profile = active_profile()
+        async def submit_all():
+            return await asyncio.gather(*(self.submit_order_async(order_data, profile) for order_data in orders_data), return_exceptions=True)
+        return self._run(submit_all())
+
+    def close(self):
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class MockTransport:
+    name = "mock"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.submitted = []
+
+    def submit_order(self, order_data):
+        if self.latency:
+            time.sleep(self.latency)
+        self.submitted.append(order_data)
+        response = dict(order_data)
+        response.update({
+            "id": str(uuid.uuid4()),
+            "client_order_id": order_data.get("client_order_id") or str(uuid.uuid4()),
+            "status": "accepted",
+            "submitted_at": datetime.now(timezone.utc).isoformat(),
+            "order_type": order_data["type"],
+            "filled_qty": "0",
+            "filled_avg_price": None
+        })
+        return response